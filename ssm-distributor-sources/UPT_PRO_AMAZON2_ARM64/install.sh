@@ -3,5 +3,20 @@
 # Distributor package installer - Amazon Linux 2 / RPM based distros
 #
 filename=assets-uptycs-protect-5.7.0.25-Uptycs.aarch64.rpm
+expected_sha256=
+marker_dir=/var/lib/uptycs-distributor
 
-rpm -ivh "$filename"
\ No newline at end of file
+# Skip the install when this exact package is already installed
+package_name=$(rpm -qp --queryformat '%{NAME}' "$filename" 2>/dev/null)
+package_version=$(rpm -qp --queryformat '%{VERSION}-%{RELEASE}' "$filename" 2>/dev/null)
+installed_version=$(rpm -q --queryformat '%{VERSION}-%{RELEASE}' "$package_name" 2>/dev/null)
+marker="$marker_dir/$package_name.sha256"
+if [ -n "$expected_sha256" ] && [ -n "$package_version" ] && \
+   [ "$installed_version" = "$package_version" ] && \
+   [ "$(cat "$marker" 2>/dev/null)" = "$expected_sha256" ]; then
+  echo "$package_name $package_version is already installed"
+  exit 0
+fi
+
+rpm -Uvh --replacepkgs "$filename" || exit $?
+mkdir -p "$marker_dir" && echo "$expected_sha256" > "$marker"
@@ -3,9 +3,24 @@
 # Distributor package installer - Ubuntu based distros
 #
 filename=assets-uptycs-protect-5.7.0.25-Uptycs.deb
+expected_sha256=
+marker_dir=/var/lib/uptycs-distributor
+
+# Skip the install when this exact package is already installed
+package_name=$(dpkg-deb -f "$filename" Package 2>/dev/null)
+package_version=$(dpkg-deb -f "$filename" Version 2>/dev/null)
+installed=$(dpkg-query -W -f='${Status} ${Version}' "$package_name" 2>/dev/null)
+marker="$marker_dir/$package_name.sha256"
+if [ -n "$expected_sha256" ] && [ -n "$package_version" ] && \
+   [ "$installed" = "install ok installed $package_version" ] && \
+   [ "$(cat "$marker" 2>/dev/null)" = "$expected_sha256" ]; then
+  echo "$package_name $package_version is already installed"
+  exit 0
+fi
 
 Install() {
-  dpkg -i $filename
+  dpkg -i "$1"
 }
 
-Install $filename
\ No newline at end of file
+Install "$filename" || exit $?
+mkdir -p "$marker_dir" && echo "$expected_sha256" > "$marker"
@@ -4,5 +4,47 @@
 #>
 [CmdletBinding()]
 $filename = "assets-osquery-5.5.1.14-Uptycs-windows.msi"
+$expectedSha256 = ""
+$markerDir = Join-Path $env:ProgramData "Uptycs\Distributor"
+
+function Get-MsiProperty([string]$Path, [string]$Property) {
+    $installer = New-Object -ComObject WindowsInstaller.Installer
+    $database = $installer.GetType().InvokeMember("OpenDatabase", "InvokeMethod", $null, $installer, @($Path, 0))
+    $query = "SELECT Value FROM Property WHERE Property = '$Property'"
+    $view = $database.GetType().InvokeMember("OpenView", "InvokeMethod", $null, $database, $query)
+    $view.GetType().InvokeMember("Execute", "InvokeMethod", $null, $view, $null) | Out-Null
+    $record = $view.GetType().InvokeMember("Fetch", "InvokeMethod", $null, $view, $null)
+    $value = $record.GetType().InvokeMember("StringData", "GetProperty", $null, $record, 1)
+    $view.GetType().InvokeMember("Close", "InvokeMethod", $null, $view, $null) | Out-Null
+    return $value
+}
+
+# Skip the install when this exact package is already installed
+try {
+    $msiPath = (Resolve-Path $filename).Path
+    $productCode = Get-MsiProperty $msiPath "ProductCode"
+    $productVersion = Get-MsiProperty $msiPath "ProductVersion"
+    $marker = Join-Path $markerDir "$productCode.sha256"
+    $uninstallKeys = @(
+        "HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall\$productCode",
+        "HKLM:\SOFTWARE\WOW6432Node\Microsoft\Windows\CurrentVersion\Uninstall\$productCode")
+    $installedVersion = $uninstallKeys | ForEach-Object {
+        (Get-ItemProperty -Path $_ -ErrorAction SilentlyContinue).DisplayVersion } | Select-Object -First 1
+    $installedSha256 = Get-Content -Path $marker -ErrorAction SilentlyContinue | Select-Object -First 1
+} catch {
+    $marker = Join-Path $markerDir "$filename.sha256"
+    $productVersion = $null
+}
+if ($expectedSha256 -and $productVersion -and $installedVersion -eq $productVersion -and
+    $installedSha256 -eq $expectedSha256) {
+    Write-Output "$filename $productVersion is already installed"
+    exit 0
+}
+
 $arguments = "/i `"$filename`" /qn"
-Start-Process "msiexec.exe" -ArgumentList $arguments -Wait
\ No newline at end of file
+$process = Start-Process "msiexec.exe" -ArgumentList $arguments -Wait -PassThru
+if ($process.ExitCode -notin 0, 3010) {
+    exit $process.ExitCode
+}
+New-Item -ItemType Directory -Force -Path $markerDir | Out-Null
+Set-Content -Path $marker -Value $expectedSha256
@@ -0,0 +1,246 @@
+"""
+Parses, validates and expands the Uptycs agent mapping file
+"""
+
+import json
+from typing import Dict, List, Optional, Tuple
+
+OS_TYPES = ['windows', 'linux']
+
+
+class AgentMappingError(ValueError):
+    """Exception raised when the agent mapping file does not match the expected schema."""
+
+
+class AgentMapping:
+    """
+    Class to represent the mapping of operating systems to Uptycs agent packages.
+
+    Each entry in the mapping file describes one or more distributor targets. An entry may use
+    the original flat form::
+
+        {"upt_package": "centos", "name": "amazon", "dir": "UPT_PRO_AMAZON2_x86_64",
+         "major_version": "_any", "minor_version": "", "arch_type": "x86_64"}
+
+    or the expanded form, which targets several versions and architectures at once::
+
+        {"upt_package": "debian", "name": "ubuntu",
+         "dirs": {"x86_64": "UPT_PRO_UBUNTU_x86_64", "arm64": "UPT_PRO_UBUNTU_ARM64"},
+         "versions": ["18.04", {"from": 20, "to": 24, "step": 2, "minor": "04"}]}
+
+    A version range expands to every major version from "from" to "to" (inclusive) in
+    increments of "step", with the optional "minor" version appended.
+    """
+
+    RANGE_KEYS = {'from', 'to', 'step', 'minor'}
+
+    def __init__(self, mapping: Dict, available_dirs: Optional[List[str]] = None):
+        """
+        Initializes an instance of the AgentMapping class and validates the mapping.
+
+        Args:
+            mapping (Dict): The parsed contents of the mapping file.
+            available_dirs (List[str], optional): The directories that exist on disk. When
+                provided every directory referenced by the mapping must be in this list.
+
+        Raises:
+            AgentMappingError: If the mapping does not match the schema.
+        """
+        self.mapping = mapping
+        self.targets: List[Dict] = []
+        errors = self._validate(mapping, available_dirs)
+        if errors:
+            raise AgentMappingError('Invalid agent mapping:\n  ' + '\n  '.join(errors))
+
+    @classmethod
+    def from_file(cls, filename: str, available_dirs: Optional[List[str]] = None):
+        """
+        Parses the specified file and returns the validated agent mapping.
+
+        Args:
+            filename (str): The name of the file to parse.
+            available_dirs (List[str], optional): The directories that exist on disk.
+
+        Returns:
+            AgentMapping: The validated agent mapping.
+        """
+        try:
+            with open(filename, 'rb') as file_handle:
+                mapping = json.loads(file_handle.read())
+        except json.JSONDecodeError as error:
+            raise AgentMappingError(f'Invalid agent mapping file {filename}: {error}') from error
+        return cls(mapping, available_dirs)
+
+    @property
+    def dirs(self) -> List[str]:
+        """The sorted list of directories referenced by the mapping."""
+        return sorted({target['dir'] for target in self.targets})
+
+    def _validate(self, mapping: Dict, available_dirs: Optional[List[str]]) -> List[str]:
+        """
+        Validates the mapping and expands it into self.targets.
+
+        Args:
+            mapping (Dict): The parsed contents of the mapping file.
+            available_dirs (List[str], optional): The directories that exist on disk.
+
+        Returns:
+            List[str]: A description of each problem found, empty if the mapping is valid.
+        """
+        if not isinstance(mapping, dict):
+            return ['the mapping must be a JSON object']
+        errors = [f'missing or invalid "{os_type}" list' for os_type in OS_TYPES
+                  if not isinstance(mapping.get(os_type), list)]
+        if errors:
+            return errors
+
+        seen_targets: Dict[Tuple[str, str, str], str] = {}
+        dir_downloads: Dict[str, Tuple[str, str]] = {}
+        for os_type in OS_TYPES:
+            for index, entry in enumerate(mapping[os_type]):
+                location = f'{os_type}[{index}]'
+                entry_errors, targets = self._expand_entry(entry, location)
+                errors.extend(entry_errors)
+                for target in targets:
+                    target_key = (target['name'], target['version'], target['arch_type'])
+                    if target_key in seen_targets:
+                        errors.append(f'{location}: {"/".join(target_key)} is already '
+                                      f'defined by {seen_targets[target_key]}')
+                        continue
+                    seen_targets[target_key] = location
+                    download = (target['upt_package'], target['arch_type'])
+                    if dir_downloads.setdefault(target['dir'], download) != download:
+                        errors.append(f'{location}: directory {target["dir"]} is used for more '
+                                      f'than one package or architecture')
+                    self.targets.append(target)
+
+        if available_dirs is not None:
+            errors.extend(f'directory {_dir} does not exist' for _dir in
+                          sorted(set(dir_downloads) - set(available_dirs)))
+        return errors
+
+    def _expand_entry(self, entry: Dict, location: str) -> Tuple[List[str], List[Dict]]:
+        """
+        Validates a single mapping entry and expands it into one target per version and arch.
+
+        Args:
+            entry (Dict): The mapping entry.
+            location (str): Where the entry is in the mapping, used in error messages.
+
+        Returns:
+            Tuple[List[str], List[Dict]]: The problems found and the expanded targets.
+        """
+        if not isinstance(entry, dict):
+            return [f'{location}: entries must be JSON objects'], []
+        errors = [f'{location}: "{key}" must be a non-empty string'
+                  for key in ('upt_package', 'name') if not self._is_text(entry.get(key))]
+
+        arch_dirs, arch_errors = self._entry_dirs(entry)
+        versions, version_errors = self._entry_versions(entry)
+        errors.extend(f'{location}: {error}' for error in arch_errors + version_errors)
+        if errors:
+            return errors, []
+
+        targets = []
+        for version in versions:
+            major_version, _, minor_version = version.partition('.')
+            for arch_type, _dir in arch_dirs.items():
+                targets.append({
+                    'upt_package': entry['upt_package'],
+                    'id': entry.get('id', entry['name']),
+                    'dir': _dir,
+                    'name': entry['name'],
+                    'version': version,
+                    'major_version': major_version,
+                    'minor_version': minor_version,
+                    'arch_type': arch_type
+                })
+        return errors, targets
+
+    def _entry_dirs(self, entry: Dict) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Returns the directory used for each architecture of a mapping entry.
+
+        Args:
+            entry (Dict): The mapping entry.
+
+        Returns:
+            Tuple[Dict[str, str], List[str]]: The directories keyed by arch and any problems.
+        """
+        if ('dir' in entry) == ('dirs' in entry):
+            return {}, ['exactly one of "dir" or "dirs" is required']
+        if 'dir' in entry:
+            if not self._is_text(entry['dir']) or not self._is_text(entry.get('arch_type')):
+                return {}, ['"dir" and "arch_type" must be non-empty strings']
+            return {entry['arch_type']: entry['dir']}, []
+        arch_dirs = entry['dirs']
+        if not isinstance(arch_dirs, dict) or not arch_dirs or not all(
+                self._is_text(arch) and self._is_text(_dir) for arch, _dir in arch_dirs.items()):
+            return {}, ['"dirs" must map each arch type to a directory name']
+        return arch_dirs, []
+
+    def _entry_versions(self, entry: Dict) -> Tuple[List[str], List[str]]:
+        """
+        Returns the versions targeted by a mapping entry.
+
+        Args:
+            entry (Dict): The mapping entry.
+
+        Returns:
+            Tuple[List[str], List[str]]: The version strings and any problems.
+        """
+        if ('major_version' in entry) == ('versions' in entry):
+            return [], ['exactly one of "major_version" or "versions" is required']
+        if 'major_version' in entry:
+            major_version = entry['major_version']
+            minor_version = entry.get('minor_version', '')
+            if not self._is_text(major_version) or not isinstance(minor_version, str):
+                return [], ['"major_version" and "minor_version" must be strings']
+            return [f'{major_version}.{minor_version}' if minor_version else major_version], []
+
+        if not isinstance(entry['versions'], list) or not entry['versions']:
+            return [], ['"versions" must be a non-empty list']
+        versions: List[str] = []
+        errors: List[str] = []
+        for item in entry['versions']:
+            if self._is_text(item):
+                versions.append(item)
+            elif isinstance(item, dict):
+                expanded, error = self._expand_range(item)
+                versions.extend(expanded)
+                if error:
+                    errors.append(error)
+            else:
+                errors.append(f'invalid version {item!r}')
+        unique_versions: set = set()
+        duplicates = sorted({version for version in versions
+                             if version in unique_versions or unique_versions.add(version)})
+        if duplicates:
+            errors.append(f'versions listed more than once: {", ".join(duplicates)}')
+        return versions, errors
+
+    def _expand_range(self, version_range: Dict) -> Tuple[List[str], Optional[str]]:
+        """
+        Expands a version range into the individual version strings.
+
+        Args:
+            version_range (Dict): A dict with "from", "to" and optional "step" and "minor" keys.
+
+        Returns:
+            Tuple[List[str], Optional[str]]: The version strings and a problem, if any.
+        """
+        unknown_keys = set(version_range) - self.RANGE_KEYS
+        start, end = version_range.get('from'), version_range.get('to')
+        step = version_range.get('step', 1)
+        minor = version_range.get('minor', '')
+        if unknown_keys or not all(isinstance(value, int) and not isinstance(value, bool)
+                                   for value in (start, end, step)) \
+                or not isinstance(minor, str) or step < 1 or start > end:
+            return [], f'invalid version range {json.dumps(version_range, sort_keys=True)}'
+        suffix = f'.{minor}' if minor else ''
+        return [f'{major}{suffix}' for major in range(start, end + 1, step)], None
+
+    @staticmethod
+    def _is_text(value) -> bool:
+        """Returns True if the value is a non-empty string."""
+        return isinstance(value, str) and bool(value)
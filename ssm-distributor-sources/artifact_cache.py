@@ -0,0 +1,196 @@
+"""
+Shares downloaded installers between packaging runs through an S3 bucket or S3-compatible store
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+from payload_verifier import PayloadVerifier
+from transfer_qos import DOWNLOAD, UPLOAD, TransferQos
+
+CACHE_URL_PATTERN = re.compile(r'^s3://(?P<bucket>[^/]+)/?(?P<prefix>.*)$')
+
+
+class ArtifactCache:
+    """
+    Class to read and populate a remote cache of installers.
+
+    Each installer is stored under a key built from the parameters of its download request:
+    <prefix>/<osqVersion>/<asset group id>/<upt_package>/<arch>/<remediation|sensor>/<file>.
+    The SHA-256 digest of the installer is stored in the object metadata. Whenever the installer
+    is read back, its size, digest and package structure are verified, so a corrupt or tampered
+    entry is ignored and the installer is downloaded from the Uptycs API instead. The cache never
+    fails a run: errors reading or writing it are reported and treated as a cache miss.
+    """
+
+    def __init__(self, cache_url: str, s3_client, qos: Optional[TransferQos] = None):
+        """
+        Initializes an instance of the ArtifactCache class.
+
+        Args:
+            cache_url (str): The cache location, in the form s3://bucket/prefix.
+            s3_client (S3.Client): The client for the bucket. Its endpoint may be any
+                S3-compatible store.
+            qos (TransferQos, optional): The bandwidth limits applied to cache transfers.
+
+        Raises:
+            ValueError: If the cache URL is not an s3:// URL.
+        """
+        match = CACHE_URL_PATTERN.match(cache_url)
+        if not match:
+            raise ValueError(f'The cache location {cache_url} must be in the form '
+                             f's3://bucket/prefix')
+        self.bucket = match.group('bucket')
+        self.prefix = match.group('prefix').strip('/')
+        self.s3_client = s3_client
+        self.qos: TransferQos = qos or TransferQos()
+        self.verifier = PayloadVerifier()
+
+    def entry_prefix(self, os_name: str, query_params: Optional[Dict[str, str]],
+                     asset_group_id: Optional[str]) -> str:
+        """
+        Returns the key prefix of the cache entry for a download request.
+
+        Args:
+            os_name (str): The name of the OS, as expected by the Uptycs API.
+            query_params (Dict[str, str], optional): The query parameters of the download.
+            asset_group_id (str, optional): The asset group the installer is built for.
+
+        Returns:
+            str: The key prefix, ending with "/".
+        """
+        params = query_params or {}
+        arch = 'arm64' if params.get('gravitonPackage') == 'true' else 'x86_64'
+        remediation = 'remediation' if params.get('remediationPackage') == 'true' else 'sensor'
+        parts = [self.prefix, params.get('osqVersion', 'latest'), str(asset_group_id), os_name,
+                 arch, remediation]
+        return '/'.join(part for part in parts if part) + '/'
+
+    def lookup(self, entry: str) -> Optional[Dict]:
+        """
+        Finds the installer stored for a cache entry.
+
+        Args:
+            entry (str): The key prefix returned by entry_prefix().
+
+        Returns:
+            Optional[Dict]: The key, file name, size and SHA-256 digest of the installer, or
+            None if the entry is empty or cannot be read.
+        """
+        try:
+            response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=entry)
+            for item in response.get('Contents', []):
+                metadata = self.s3_client.head_object(Bucket=self.bucket,
+                                                      Key=item['Key']).get('Metadata', {})
+                if metadata.get('sha256'):
+                    return {'key': item['Key'], 'file_name': item['Key'][len(entry):],
+                            'size': item['Size'], 'sha256': metadata['sha256']}
+        except (BotoCoreError, ClientError) as err:
+            print(f'Unable to read the artifact cache at {entry}: {err}')
+        return None
+
+    def fetch(self, entry: str, dir_name: str) -> Optional[Tuple[str, Dict]]:
+        """
+        Copies the installer of a cache entry into a directory and verifies it. An entry that
+        fails verification is removed from the cache.
+
+        Args:
+            entry (str): The key prefix returned by entry_prefix().
+            dir_name (str): The directory to save the installer in.
+
+        Returns:
+            Optional[Tuple[str, Dict]]: The file name and the expected size and digest of the
+            installer, for the payload verifier, or None on a cache miss.
+        """
+        found = self.lookup(entry)
+        if found is None:
+            return None
+        expected = {'size': found['size'], 'sha256': found['sha256']}
+        file_path = os.path.join(dir_name, found['file_name'])
+        if os.path.isfile(file_path) and os.path.getsize(file_path) == found['size'] and \
+                not self.verifier.verify(file_path, expected):
+            print(f'Already downloaded {file_path} - Skipping cache download')
+            return found['file_name'], expected
+
+        # Download next to the target under the same file name, so it can be verified as a
+        # package and then moved into place
+        os.makedirs(dir_name, exist_ok=True)
+        part_dir = tempfile.mkdtemp(prefix='.cache-', dir=dir_name)
+        part_path = os.path.join(part_dir, found['file_name'])
+        try:
+            self.s3_client.download_file(self.bucket, found['key'], part_path,
+                                         Callback=self.qos.callback(DOWNLOAD),
+                                         Config=TransferConfig(use_threads=False))
+            problems = self.verifier.verify(part_path, expected)
+            if problems:
+                # Remove the bad entry so that it is replaced once the installer is downloaded
+                print(f'Removing cached {found["key"]}: {"; ".join(problems)}')
+                self.s3_client.delete_object(Bucket=self.bucket, Key=found['key'])
+                return None
+            os.replace(part_path, file_path)
+        except (BotoCoreError, ClientError, OSError) as err:
+            print(f'Unable to read {found["key"]} from the artifact cache: {err}')
+            return None
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+        print(f'Copied {file_path} from the artifact cache')
+        return found['file_name'], expected
+
+    def store(self, entry: str, file_path: str) -> bool:
+        """
+        Adds a verified installer to the cache, replacing any other file in its entry.
+
+        Args:
+            entry (str): The key prefix returned by entry_prefix().
+            file_path (str): The installer to store.
+
+        Returns:
+            bool: True if the installer was stored or was already cached, else False.
+        """
+        problems = self.verifier.verify(file_path)
+        if problems:
+            print(f'Not adding {file_path} to the artifact cache: {"; ".join(problems)}')
+            return False
+        digest = self.verifier.digests[file_path]
+        object_key = entry + os.path.basename(file_path)
+        try:
+            found = self.lookup(entry)
+            if found and found['key'] == object_key and found['sha256'] == digest:
+                return True
+            self.s3_client.upload_file(file_path, self.bucket, object_key,
+                                       ExtraArgs={'Metadata': {'sha256': digest}},
+                                       Callback=self.qos.callback(UPLOAD),
+                                       Config=TransferConfig(use_threads=False))
+            response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=entry)
+            stale = [{'Key': item['Key']} for item in response.get('Contents', [])
+                     if item['Key'] != object_key]
+            if stale:
+                self.s3_client.delete_objects(Bucket=self.bucket, Delete={'Objects': stale})
+            print(f'Added {os.path.basename(file_path)} to the artifact cache')
+            return True
+        except (BotoCoreError, ClientError) as err:
+            print(f'Unable to add {file_path} to the artifact cache: {err}')
+            return False
+
+    def store_all(self, entries: Dict[str, str]) -> int:
+        """
+        Adds installers to the cache, up to qos.upload_concurrency at the same time.
+
+        Args:
+            entries (Dict[str, str]): The cache entry of each installer, keyed by file path.
+
+        Returns:
+            int: The number of installers stored.
+        """
+        if not entries:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.qos.upload_concurrency) as executor:
+            return sum(executor.map(lambda item: self.store(item[1], item[0]),
+                                    entries.items()))
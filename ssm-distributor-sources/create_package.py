@@ -1,8 +1,10 @@
 """
 Creates Uptycs distributor package
 """
+# pylint: disable=C0302
 
 import argparse
+import asyncio
 import datetime
 import hashlib
 import json
@@ -10,27 +12,40 @@ import logging
 import os
 import random
 import re
+import shutil
 import string
 import sys
+import threading
 import time
 import zipfile
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import BotoCoreError, ClientError
+from boto3.s3.transfer import TransferConfig
 import boto3
+import botocore.config
 import jwt
 import requests
 import urllib3
+from agent_mapping import AgentMapping, AgentMappingError
+from artifact_cache import CACHE_URL_PATTERN, ArtifactCache
+from package_retention import PackageRetention, RetentionError, RetentionPlan
+from payload_verifier import PACKAGE_SIGNATURES, PayloadVerificationError, PayloadVerifier
+from preflight import (MIN_FREE_DISK_BYTES, PreflightCheck, PreflightFailure, PreflightRunner,
+                       check_free_disk_space)
+from stage_profiler import StageProfiler, add_profiler_arguments
+from transfer_qos import DEFAULT_CONCURRENCY, DOWNLOAD, MIB, UPLOAD, TransferQos
 
 urllib3.disable_warnings()
 S3PREFIX = 'uptycs'
 TIMEOUT = 9000
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
 ASSET_GRP_NAME = 'assets'
 PATH_TO_BUCKET_FOLDER = '../s3-bucket/'
+QUARANTINE_FOLDER = '../quarantine/'
 PACKAGE_NAME = 'UptycsAgent'
 INSTALLER_VERSION = '1.0'
-OS_LIST = ['windows', 'linux']
 MAP_FILE = 'uptycs-agent-mapping.json'
-AUTHFILE = 'apikey.json'
 PACKAGE_DESCRIPTION = \
     'The Uptycs platform provides you with osquery installation packages for ' \
     'all supported operating systems, configures it for optimal data collection, ' \
@@ -44,53 +59,324 @@ class DistributorFilePackager:
     """
     OSQUERY_PACKAGE_NAME_TEMPLATE = '{dir}-{version}.zip'
 
-    def __init__(self, installer_version: str, with_remediation: bool):
+    def __init__(self, installer_version: str, with_remediation: bool,
+                 qos: Optional[TransferQos] = None, checksum_catalog: Optional[str] = None,
+                 clients: Optional['PackagingClients'] = None, source_dir: str = '.',
+                 staging_dir: Optional[str] = None, map_file: str = MAP_FILE,
+                 cache: Optional[ArtifactCache] = None):
+        # pylint: disable=R0913,R0917
         """
         Initializes an instance of the DistributorFilePackager class.
 
         Args:
             installer_version (str): The version of the installer package.
             with_remediation (bool): Whether or not to include the remediation package.
+            qos (TransferQos, optional): The bandwidth and concurrency limits for downloads and
+                uploads. Transfers are unlimited if not set.
+            checksum_catalog (str, optional): A JSON file of trusted installer checksums that
+                every installer must match.
+            clients (PackagingClients, optional): The Uptycs API and S3 clients to use. Needed
+                to download or upload files.
+            source_dir (str): The directory holding the mapping file and the install script
+                directories. Concurrent builds must each use their own source_dir.
+            staging_dir (str, optional): The directory the zip files and manifest are written
+                to. Defaults to the s3-bucket folder next to source_dir.
+            map_file (str): The agent mapping file, relative to source_dir.
+            cache (ArtifactCache, optional): A shared cache of installers, read before the
+                Uptycs API and populated with the installers downloaded from it.
         """
         self.logger = LogHandler(str(self.__class__))
+        self.qos: TransferQos = qos or TransferQos()
+        self.clients = clients
+        self.cache = cache
+        self.source_dir = source_dir
+        self.staging_dir = staging_dir or os.path.join(source_dir, PATH_TO_BUCKET_FOLDER)
+        self.verifier = PayloadVerifier(checksum_catalog,
+                                        os.path.join(source_dir, QUARANTINE_FOLDER))
         self.manifest_dict: Dict = {}
         self.with_remediation: bool = with_remediation
-        self.dirs: set = set()
-        self.zip_file_list: set = set()
-        self.build_configs: Dict = self._parse_mappings(MAP_FILE)
-        self.dir_list: List[str] = os.listdir()
+        self.zip_aliases: Dict[str, str] = {}
+        self.dir_list: List[str] = os.listdir(source_dir)
+        self.agent_mapping = AgentMapping.from_file(os.path.join(source_dir, map_file),
+                                                    self.dir_list)
+        self.targets: List[Dict] = self.agent_mapping.targets
+        self.dirs: set = set(self.agent_mapping.dirs)
         self.installer_version: str = installer_version
-        for os_type in OS_LIST:
-            for installer in self.build_configs[os_type]:
-                self.dirs.add(installer['dir'])
-                self.zip_file_list.add(
-                    self.OSQUERY_PACKAGE_NAME_TEMPLATE.format(dir=installer["dir"],
-                                                              version=self.installer_version))
+        self.zip_file_list: set = {self._zip_file_name(_dir) for _dir in self.dirs}
 
     def download_osquery_files(self) -> None:
-        """Download the osquery files for each operating system type and architecture."""
-        for os_type in OS_LIST:
-            for installer in self.build_configs[os_type]:
-                self._add_binary_to_dir(installer)
+        """
+        Download the osquery files for each operating system type and architecture.
+
+        Installers that resolve to the same download request are fetched once and then
+        linked or copied into every directory that needs them. Up to
+        qos.download_concurrency packages are downloaded at the same time. Every download is
+        verified before it is reused in other directories. With an artifact cache, each
+        installer is read from the cache if it is there, and the installers downloaded from
+        the Uptycs API are added to the cache once they have been verified.
+        """
+        package_download_api = PackageDownloadsApi(self.qos, self._api_client(), self.cache)
+        download_groups = list(self._group_downloads().values())
+        with ThreadPoolExecutor(max_workers=self.qos.download_concurrency) as executor:
+            file_names = list(executor.map(
+                lambda installers: self._add_binary_to_dir(installers[0], package_download_api),
+                download_groups))
+        print(self.qos.summary(DOWNLOAD))
+        downloaded = [os.path.join(self._dir_path(installers[0]['dir']), file_name)
+                      for installers, file_name in zip(download_groups, file_names)]
+        self.verify_payloads({path: package_download_api.expected_payloads.get(path, {})
+                              for path in downloaded})
+        if self.cache:
+            self.cache.store_all(package_download_api.cache_misses)
+        for installers, file_name in zip(download_groups, file_names):
+            source_config = installers[0]
+            source_path = os.path.join(self._dir_path(source_config['dir']), file_name)
+            for installer in installers:
+                if installer['dir'] != source_config['dir']:
+                    self._copy_binary_to_dir(self._dir_path(source_config['dir']),
+                                             self._dir_path(installer['dir']), file_name)
+                self._update_install_script(self._dir_path(installer['dir']), file_name,
+                                            installer['upt_package'],
+                                            self.verifier.digests[source_path])
+
+    def verify_payloads(self, expected: Optional[Dict[str, Dict]] = None) -> None:
+        """
+        Verify the installers in parallel before they are zipped, hashed or uploaded.
+
+        Each installer is checked against the size and digests the server sent, the checksum
+        catalog if one was given, and the structure expected of an rpm, deb or msi package.
+        Installers that fail are moved to the quarantine folder.
+
+        Args:
+            expected (Dict[str, Dict], optional): The expected values of each installer, keyed
+                by path. All installers in self.dirs are verified if not set.
+
+        Raises:
+            PayloadVerificationError: If any installer fails verification.
+        """
+        if expected is None:
+            expected = {path: {} for _dir in sorted(self.dirs)
+                        for path in self._dir_files(self._dir_path(_dir))
+                        if os.path.splitext(path)[1].lower() in PACKAGE_SIGNATURES}
+        failures = self.verifier.verify_all(expected)
+        if failures:
+            raise PayloadVerificationError('Installer verification failed:\n  ' + '\n  '.join(
+                f'{path}: {"; ".join(problems)}' for path, problems in sorted(failures.items())))
+        print(f'Verified {len(expected)} installer(s)')
+
+    def update_install_checksums(self) -> None:
+        """
+        Fill in the checksum of the installer each install script already names.
+
+        Used when the installers were added to the directories manually, so that their install
+        scripts can also skip reinstalling a package that is already installed.
+        """
+        for _dir, os_name in sorted({(self._dir_path(target['dir']), target['upt_package'])
+                                     for target in self.targets}):
+            with open(self._install_script_path(_dir, os_name), 'r', encoding='utf-8') as file:
+                match = re.search(r'^[ \t]*\$?filename[ \t]*=[ \t]*"?([^"\n]+?)"?[ \t]*$',
+                                  file.read(), flags=re.MULTILINE)
+            if not match or not os.path.isfile(os.path.join(_dir, match.group(1))):
+                continue
+            path = os.path.join(_dir, match.group(1))
+            self._update_install_script(_dir, match.group(1), os_name,
+                                        self.verifier.digests.get(path) or file_sha256(path))
 
     def create_staging_dir(self) -> None:
-        """Create a staging directory and zip files from each directory in self.dirs."""
-        for _dir in self.dirs:
+        """
+        Create a staging directory and zip files from each directory in self.dirs.
+
+        Directories with identical contents are packaged once and share a single zip file.
+        """
+        self.zip_aliases = self._group_identical_dirs()
+        self.zip_file_list = set()
+        for _dir in sorted(set(self.zip_aliases.values())):
             self._create_zip_files(_dir)
+            self.zip_file_list.add(self._zip_file_name(_dir))
         self._generate_manifest()
 
-    def add_files_to_bucket(self, bucket_name: str, aws_region: str) -> None:
+    def add_files_to_bucket(self, bucket_name: str, aws_region: str,
+                            replica_regions: Sequence[str] = ()) -> None:
         """
         Upload the zip files in self.zip_file_list to the specified S3 bucket.
 
+        The files are then copied within S3 to the regional bucket of each replica region, see
+        regional_bucket_name(), so that instances download the package from their own region.
+        The replica regions are updated at the same time.
+
         Args:
             bucket_name (str): The name of the S3 bucket.
             aws_region (str): The name of the AWS region.
+            replica_regions (Sequence[str]): The regions to copy the files to.
+
+        Raises:
+            PackageUploadError: If any file could not be uploaded or copied.
+        """
+        bucket = ManagePackageBucket(aws_region, self.qos, self.staging_dir,
+                                     self._s3_client(aws_region))
+        if not bucket.update(bucket_name, self.zip_file_list):
+            raise PackageUploadError(f'Unable to upload the package files to {bucket_name}')
+
+        def replicate(region: str) -> Optional[str]:
+            replica = regional_bucket_name(bucket_name, region)
+            replica_bucket = ManagePackageBucket(region, self.qos, self.staging_dir,
+                                                 self._s3_client(region))
+            if replica_bucket.update(replica, self.zip_file_list, source_bucket=bucket_name):
+                return None
+            return replica
+
+        if replica_regions:
+            with ThreadPoolExecutor(max_workers=len(replica_regions)) as executor:
+                failed = [name for name in executor.map(replicate, replica_regions) if name]
+            if failed:
+                raise PackageUploadError(f'Unable to copy the package files to '
+                                         f'{", ".join(failed)}')
+
+    def plan(self, bucket_name: str, aws_region: str, download: bool,
+             replica_regions: Sequence[str] = ()) -> 'BuildPlan':
+        # pylint: disable=R0914
         """
-        bucket = ManagePackageBucket(aws_region)
-        bucket.update(bucket_name, self.zip_file_list)
+        Works out the downloads, zip files and uploads a run would perform without transferring
+        any package files. Only the download response headers and the S3 object metadata are
+        read.
 
-    def _add_binary_to_dir(self, dir_config: Dict) -> None:
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+            aws_region (str): The name of the AWS region.
+            replica_regions (Sequence[str]): The regions the files would be copied to.
+            download (bool): Whether the package files would be downloaded via the API.
+
+        Returns:
+            BuildPlan: The steps of the run with their sizes in bytes.
+        """
+        build_plan = BuildPlan(f'Plan for {PACKAGE_NAME} version {self.installer_version}')
+        overrides: Dict[str, Dict[str, str]] = {}
+        sizes: Dict[str, Dict[str, int]] = {}
+        changed_dirs: set = set()
+        if download:
+            package_download_api = PackageDownloadsApi(api_client=self._api_client())
+            for download_key, installers in self._group_downloads().items():
+                source_config = installers[0]
+                file_name, file_size = \
+                    package_download_api.package_downloads_osquery_os_asset_group_id_head(
+                        source_config['upt_package'], self._download_params(source_config))
+                source_path = os.path.join(self._dir_path(source_config['dir']), file_name)
+                cached = os.path.isfile(source_path) and os.path.getsize(source_path) == file_size
+                sha256 = file_sha256(source_path) if cached else ''
+                action = 'cached' if cached else 'download'
+                remote = None if cached or not self.cache else self.cache.lookup(
+                    self.cache.entry_prefix(source_config['upt_package'],
+                                            self._download_params(source_config),
+                                            package_download_api.asset_group_id))
+                if remote and remote['file_name'] == file_name:
+                    action, sha256 = 'from cache', remote['sha256']
+                build_plan.add('download', action, source_path, file_size)
+                for installer in installers:
+                    script_path, current, content = self._render_install_script(
+                        self._dir_path(installer['dir']), file_name, installer['upt_package'],
+                        sha256)
+                    script_name = os.path.basename(script_path)
+                    overrides[installer['dir']] = {
+                        file_name: f'download:{download_key}',
+                        script_name: hashlib.sha256(content.encode('utf-8')).hexdigest()}
+                    sizes[installer['dir']] = {file_name: file_size,
+                                               script_name: len(content.encode('utf-8'))}
+                    if not cached or content != current:
+                        changed_dirs.add(installer['dir'])
+
+        zip_aliases = self._group_identical_dirs(overrides)
+        uploads: Dict[str, Tuple[int, bool, bool]] = {}
+        for _dir in sorted(set(zip_aliases.values())):
+            zip_file_name = self._zip_file_name(_dir)
+            zip_path = os.path.join(self.staging_dir, zip_file_name)
+            input_files = self._dir_files(self._dir_path(_dir))
+            input_sizes = {os.path.basename(path): os.path.getsize(path) for path in input_files}
+            input_sizes.update(sizes.get(_dir, {}))
+            changed = _dir in changed_dirs or not os.path.isfile(zip_path) or any(
+                os.path.getmtime(path) > os.path.getmtime(zip_path) for path in input_files)
+            shared = [alias for alias, canonical in sorted(zip_aliases.items())
+                      if canonical == _dir and alias != _dir]
+            build_plan.add('zip', 'build', zip_file_name + (
+                f' (shared with {", ".join(shared)})' if shared else ''),
+                           sum(input_sizes.values()), True)
+            if changed:
+                uploads[zip_file_name] = (sum(input_sizes.values()), True, True)
+            else:
+                uploads[zip_file_name] = (os.path.getsize(zip_path), False, False)
+
+        manifest_path = os.path.join(self.staging_dir, 'manifest.json')
+        zips_changed = any(changed for _, _, changed in uploads.values())
+        hashes = {name: '0' * 64 for name in uploads} if zips_changed \
+            else self._generate_digest(set(uploads), self.staging_dir)
+        manifest_content = self._manifest_content(self._build_manifest(zip_aliases, hashes))
+        manifest_changed = zips_changed or not os.path.isfile(manifest_path)
+        if not manifest_changed:
+            with open(manifest_path, 'r', encoding='utf-8') as file_handle:
+                manifest_changed = file_handle.read() != manifest_content
+        uploads['manifest.json'] = (len(manifest_content.encode('utf-8')), False,
+                                    manifest_changed)
+        ManagePackageBucket(aws_region, staging_dir=self.staging_dir,
+                            s3_client=self._s3_client(aws_region)).plan_update(
+                                bucket_name, uploads, build_plan)
+        for region in replica_regions:
+            ManagePackageBucket(region, staging_dir=self.staging_dir,
+                                s3_client=self._s3_client(region)).plan_update(
+                                    regional_bucket_name(bucket_name, region), uploads,
+                                    build_plan, 'replicate')
+        return build_plan
+
+    def _dir_path(self, directory: str) -> str:
+        """Returns the path of an install script directory from the mapping."""
+        return os.path.join(self.source_dir, directory)
+
+    def _s3_client(self, region_name: str):
+        """Returns the shared S3 client for a region, or None to let the bucket create one."""
+        return self.clients.s3(region_name) if self.clients else None
+
+    def _api_client(self) -> 'UptApiClient':
+        """Returns the Uptycs API client, raising UptApiError if none was given."""
+        if self.clients is None:
+            raise UptApiError('PackagingClients with an API config file are required to call '
+                              'the Uptycs API')
+        return self.clients.api
+
+    def _download_params(self, dir_config: Dict) -> Dict[str, str]:
+        """
+        Build the query parameters used to download the binary for a directory configuration.
+
+        Args:
+            dir_config (Dict): A dictionary containing the directory configuration information.
+
+        Returns:
+            Dict[str, str]: The query parameters for the package download API.
+        """
+        query_params = {
+            'osqVersion': self.installer_version
+        }
+        if dir_config.get('arch_type') == 'arm64':
+            query_params['gravitonPackage'] = 'true'
+        if self.with_remediation:
+            query_params['remediationPackage'] = 'true'
+        return query_params
+
+    def _group_downloads(self) -> Dict[tuple, List[Dict]]:
+        """
+        Group the directory configurations by the download request they would make.
+
+        Returns:
+            Dict[tuple, List[Dict]]: The directory configurations keyed by the OS package
+            name and query parameters sent to the package download API. Each directory is
+            only listed once, even when it serves several OS versions.
+        """
+        downloads: Dict[tuple, Dict[str, Dict]] = {}
+        for installer in self.targets:
+            download_key = (installer.get('upt_package'),
+                            tuple(sorted(self._download_params(installer).items())))
+            downloads.setdefault(download_key, {}).setdefault(installer['dir'], installer)
+        return {key: list(installers.values()) for key, installers in downloads.items()}
+
+    def _add_binary_to_dir(self, dir_config: Dict,
+                           package_download_api: 'PackageDownloadsApi') -> str:
         """
         Download the osquery binary for the specified directory configuration.
         Args:
@@ -99,123 +385,188 @@ class DistributorFilePackager:
                 - dir: The directory to download the osquery binary to.
                 - arch_type: The architecture of the OS, e.g. "x64", "arm64", etc.
                 - upt_package: The name of the OS, as expected by the UptApi.
+             package_download_api (PackageDownloadsApi): The API used to download the binary.
+
+        Returns:
+            str: The file name of the downloaded binary.
         """
-        working_dir = dir_config.get('dir')
+        working_dir = self._dir_path(dir_config['dir'])
         upt_arch = dir_config.get('arch_type')
         upt_os_name = dir_config.get('upt_package')
-        upt_protection_query_params = {
-            'remediationPackage': 'true'
-        }
-        arm64_query_params = {
-            'gravitonPackage': 'true'
-        }
-        query_params = {
-            'osqVersion': self.installer_version
-        }
-        if upt_arch == 'arm64':
-            query_params.update(arm64_query_params)
-        if self.with_remediation:
-            query_params.update(upt_protection_query_params)
-        package_download_api = PackageDownloadsApi()
         print(f'Downloading {upt_os_name} for {upt_arch} to folder {working_dir}')
-        package_download_api.package_downloads_osquery_os_asset_group_id_get(
+        return package_download_api.package_downloads_osquery_os_asset_group_id_get(
             upt_os_name,
             working_dir,
-            query_params
+            self._download_params(dir_config)
         )
 
     @staticmethod
-    def _parse_mappings(filename: str) -> Dict:
+    def _copy_binary_to_dir(source_dir: str, target_dir: str, file_name: str) -> None:
+        """
+        Place an already downloaded binary in another directory.
+
+        A hard link is used where the filesystem supports it, otherwise the file is copied.
+
+        Args:
+            source_dir (str): The directory the binary was downloaded to.
+            target_dir (str): The directory that needs the same binary.
+            file_name (str): The file name of the binary.
+        """
+        source_path = os.path.join(source_dir, file_name)
+        target_path = os.path.join(target_dir, file_name)
+        os.makedirs(target_dir, exist_ok=True)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copy2(source_path, target_path)
+        print(f'Reusing {file_name} from folder {source_dir} in folder {target_dir}')
+
+    @classmethod
+    def _update_install_script(cls, dir_name: str, file_name: str, os_name: str,
+                               sha256: str = '') -> None:
+        """
+        Replace the filename and checksum in the install script with those of the package.
+
+        The script is only rewritten when its content changes, so that an unchanged directory
+        produces an identical zip file.
+
+        Args:
+            dir_name (str): The directory containing the install script.
+            file_name (str): The file name of the downloaded package.
+            os_name (str): The name of the OS, as expected by the UptApi.
+            sha256 (str): The SHA-256 digest of the package.
+        """
+        install_file_path, current, content = cls._render_install_script(dir_name, file_name,
+                                                                         os_name, sha256)
+        if content != current:
+            with open(install_file_path, "w", encoding="utf-8") as file:
+                file.write(content)
+
+    @staticmethod
+    def _render_install_script(dir_name: str, file_name: str, os_name: str,
+                               sha256: str = '') -> Tuple[str, str, str]:
         """
-        Parses the specified file and returns the configuration data.
+        Render the install script for the package without writing it.
+
+        The install scripts skip the install when the same package version is installed and
+        the checksum recorded by the last install matches. The filename and expected_sha256
+        assignments ($filename and $expectedSha256 in install.ps1) are filled in here.
 
         Args:
-            filename (str): The name of the file to parse.
+            dir_name (str): The directory containing the install script.
+            file_name (str): The file name of the downloaded package.
+            os_name (str): The name of the OS, as expected by the UptApi.
+            sha256 (str): The SHA-256 digest of the package.
 
         Returns:
-            dict: The configuration data.
+            Tuple[str, str, str]: The path, current content and rendered content of the script.
         """
-        with open(filename, 'rb') as file_handle:
-            json_data = json.loads(file_handle.read())
-        return json_data
+        if os_name == 'windows':
+            assignments = {r'\$filename': f'"{file_name}"', r'\$expectedSha256': f'"{sha256}"'}
+        else:
+            assignments = {'filename': file_name, 'expected_sha256': sha256}
+        install_file_path = DistributorFilePackager._install_script_path(dir_name, os_name)
+        with open(install_file_path, "r", encoding="utf-8") as file:
+            current = file.read()
+        content = current
+        for variable, value in assignments.items():
+            content = re.sub(rf'^([ \t]*{variable}[ \t]*=[ \t]*)[^\n]*',
+                             lambda match, value=value: match.group(1) + value,
+                             content, flags=re.MULTILINE)
+        return install_file_path, current, content
+
+    @staticmethod
+    def _install_script_path(dir_name: str, os_name: str) -> str:
+        """Returns the path of the install script in a directory."""
+        return os.path.join(dir_name, 'install.ps1' if os_name == 'windows' else 'install.sh')
 
     def _generate_manifest(self) -> None:
-        # pylint: disable=R0914:
         """
         Generates the manifest.json file required to create the ssm document.
+
+        Raises:
+            ManifestError: If the manifest could not be built from the zip files.
         """
-        # Create an empty dictionary to hold the instance information for each OS type and version.
-        manifest_instance_info = {}
+        # Generate a SHA256 digest for each file in the zip file list and add its information to
+        # the manifest.
+        try:
+            hashes = self._generate_digest(self.zip_file_list, self.staging_dir)
+            self.manifest_dict = self._build_manifest(self.zip_aliases, hashes)
 
+            # Write the manifest file to the S3 bucket folder and add it to the zip file list.
+            manifest_file_path = os.path.join(self.staging_dir, 'manifest.json')
+            self._write_manifest_file(manifest_file_path, self.manifest_dict)
+            self.zip_file_list.add('manifest.json')
+
+        except (KeyError, ValueError) as err:
+            raise ManifestError(f'Unable to generate the package manifest: {err}') from err
+
+    def _build_manifest(self, zip_aliases: Dict[str, str], hashes: Dict[str, str]) -> Dict:
+        """
+        Builds the manifest content.
+
+        Args:
+            zip_aliases (Dict[str, str]): The directory whose zip file is used for each directory.
+            hashes (Dict[str, str]): The SHA-256 digest of each zip file, keyed by file name.
+
+        Returns:
+            Dict: The manifest.
+        """
         # Initialize the manifest dictionary with the required fields.
-        self.manifest_dict = {
+        manifest_dict = {
             "schemaVersion": "2.0",
             "publisher": "Uptycs.",
             "description": PACKAGE_DESCRIPTION,
             "version": self.installer_version
         }
 
-        # Iterate through each OS type and configuration and add its information to the manifest.
-        for os_type in OS_LIST:
-            for config in self.build_configs[os_type]:
-                name = config['name']
-                arch_type = config['arch_type']
-                version = config['major_version']
-                if not len(config['minor_version']) == 0:
-                    version = version + "." + config['minor_version']
-                if name in manifest_instance_info:
-                    pass
-                else:
-                    manifest_instance_info[name] = {}
-
-                if version in manifest_instance_info[name]:
-                    pass
-                else:
-                    manifest_instance_info[name][version] = {}
-
-                if arch_type in manifest_instance_info[name][version]:
-                    pass
-                else:
-                    manifest_instance_info[name][version][arch_type] = {}
-
-                zip_file_name = self.OSQUERY_PACKAGE_NAME_TEMPLATE.format(
-                    dir=config["dir"],
-                    version=self.installer_version)
-                manifest_instance_info[name][version][arch_type] = {'file': zip_file_name}
+        # Add the zip file used by each OS name, version and architecture in a single pass.
+        manifest_instance_info: Dict[str, Dict[str, Dict[str, Dict[str, str]]]] = {}
+        for target in self.targets:
+            zip_file_name = self._zip_file_name(zip_aliases.get(target['dir'], target['dir']))
+            manifest_instance_info.setdefault(target['name'], {}).setdefault(
+                target['version'], {})[target['arch_type']] = {'file': zip_file_name}
+        manifest_dict["packages"] = manifest_instance_info
+        manifest_dict["files"] = {filename: {'checksums': {"sha256": hash_val}}
+                                  for filename, hash_val in hashes.items()}
+        return manifest_dict
 
-        # Generate a SHA256 digest for each file in the zip file list and add its information to
-        # the manifest.
-        try:
-            hashes = self._generate_digest(self.zip_file_list)
-            self.manifest_dict["packages"] = manifest_instance_info
-            obj = {}
-            for hash_val in hashes:
-                for key, val in hash_val.items():
-                    obj.update({key: {'checksums': {"sha256": val}}})
-            file_list = {"files": obj}
-            self.manifest_dict.update(file_list)
+    @staticmethod
+    def _manifest_content(json_data: Dict) -> str:
+        """
+        Returns the manifest file content, with keys in sorted order so that the same inputs
+        always produce the same file.
 
-            # Write the manifest file to the S3 bucket folder and add it to the zip file list.
-            manifest_file_path = PATH_TO_BUCKET_FOLDER + 'manifest.json'
-            self._write_manifest_file(manifest_file_path, self.manifest_dict)
-            self.zip_file_list.add('manifest.json')
+        Args:
+            json_data (Dict): The manifest.
 
-        # Log an error message if there are any exceptions while generating the manifest.
-        except (KeyError, ValueError) as err:
-            self.logger.error(f'Exception {err}')
+        Returns:
+            str: The JSON text written to manifest.json.
+        """
+        return json.dumps(json_data, sort_keys=True, indent=2) + '\n'
 
-    @staticmethod
-    def _write_manifest_file(file: str, json_data: Dict) -> None:
+    @classmethod
+    def _write_manifest_file(cls, file: str, json_data: Dict) -> None:
         """
         Write the given JSON data to the specified file.
 
+        An existing file with identical content is left untouched.
+
         Args:
             file (str): The file to write the data to.
             json_data (Dict): The JSON data to write.
         """
+        content = cls._manifest_content(json_data)
         try:
+            if os.path.isfile(file):
+                with open(file, 'r', encoding="utf-8") as file_handle:
+                    if file_handle.read() == content:
+                        print('Manifest file is unchanged')
+                        return
             with open(file, 'w', encoding="utf-8") as file_handle:
-                file_handle.write(json.dumps(json_data))
+                file_handle.write(content)
                 print('Writing manifest file')
         except (FileNotFoundError, FileExistsError, OSError) as err:
             print(err)
@@ -229,42 +580,223 @@ class DistributorFilePackager:
             directory (str): The directory to create a zip file from.
         """
         # Generate the path to the zip file
-        zip_path = os.path.join(PATH_TO_BUCKET_FOLDER, f"{directory}-{self.installer_version}.zip")
+        zip_path = os.path.join(self.staging_dir, self._zip_file_name(directory))
 
         # Create any necessary directories for the zip file
         os.makedirs(os.path.dirname(zip_path), exist_ok=True)
 
         # Create the zip file and write the contents of the directory to it
         with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, file_list in os.walk(f"{directory}/"):
-                for file in file_list:
-                    file_path = os.path.join(root, file)
-                    zipf.write(file_path, os.path.basename(file_path))
+            for file_path in self._dir_files(self._dir_path(directory)):
+                zipf.write(file_path, os.path.basename(file_path))
 
         # Output a message to indicate that the zip file was successfully created
         print(f'Successfully created zip file: {zip_path}')
 
+    def _zip_file_name(self, directory: str) -> str:
+        """
+        Returns the name of the zip file built from the specified directory.
+
+        Args:
+            directory (str): The directory the zip file is built from.
+
+        Returns:
+            str: The zip file name.
+        """
+        return self.OSQUERY_PACKAGE_NAME_TEMPLATE.format(dir=directory,
+                                                         version=self.installer_version)
+
+    def _group_identical_dirs(self, overrides: Optional[Dict[str, Dict[str, str]]] = None
+                              ) -> Dict[str, str]:
+        """
+        Map each directory to the first directory (in sorted order) with identical contents.
+
+        Args:
+            overrides (Dict[str, Dict[str, str]], optional): Per directory, the digests to use
+                for files instead of reading them from disk. Used to group directories before
+                their files have been downloaded.
+
+        Returns:
+            Dict[str, str]: The directory whose zip file should be used for each directory.
+        """
+        file_hashes: Dict[tuple, str] = {}
+        fingerprints: Dict[str, str] = {}
+        aliases: Dict[str, str] = {}
+        for _dir in sorted(self.dirs):
+            fingerprint = self._dir_fingerprint(self._dir_path(_dir), file_hashes,
+                                                (overrides or {}).get(_dir))
+            aliases[_dir] = fingerprints.setdefault(fingerprint, _dir)
+            if aliases[_dir] != _dir and overrides is None:
+                print(f'Folder {_dir} is identical to {aliases[_dir]} - sharing its zip file')
+        return aliases
+
     @staticmethod
-    def _generate_digest(zip_file_list: set) -> List[Dict[str, str]]:
+    def _dir_fingerprint(directory: str, file_hashes: Dict[tuple, str],
+                         overrides: Optional[Dict[str, str]] = None) -> str:
+        """
+        Generate a digest of the files that would be added to the zip file for a directory.
+
+        Args:
+            directory (str): The directory to fingerprint.
+            file_hashes (Dict[tuple, str]): Digests already computed, keyed by inode, so that
+                linked copies of the same binary are only read once.
+            overrides (Dict[str, str], optional): Digests to use for the named files instead of
+                reading them, including files that do not exist yet.
+
+        Returns:
+            str: A SHA-256 digest of the file names and contents.
+        """
+        digests = dict(overrides or {})
+        for file_path in DistributorFilePackager._dir_files(directory):
+            file = os.path.basename(file_path)
+            if file in digests:
+                continue
+            stat = os.stat(file_path)
+            inode_key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if inode_key not in file_hashes:
+                file_hashes[inode_key] = file_sha256(file_path)
+            digests[file] = file_hashes[inode_key]
+        entries = [f'{file}:{digest}' for file, digest in sorted(digests.items())]
+        return hashlib.sha256('\n'.join(entries).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _dir_files(directory: str) -> List[str]:
+        """
+        Returns the paths of the files that are added to the zip file for a directory.
+
+        Args:
+            directory (str): The directory to list.
+
+        Returns:
+            List[str]: The file paths in a stable order.
+        """
+        return sorted(os.path.join(root, file)
+                      for root, _, file_list in os.walk(f"{directory}/") for file in file_list)
+
+    @staticmethod
+    def _generate_digest(zip_file_list: set,
+                         staging_dir: str = PATH_TO_BUCKET_FOLDER) -> Dict[str, str]:
         """
         Generate a SHA-256 digest for each file in the provided list.
 
         Args:
             zip_file_list (set): A set of file names to generate the digests for.
+            staging_dir (str): The directory holding the files.
+
+        Returns:
+            Dict[str, str]: The SHA-256 digest of each file, keyed by file name.
+        """
+        return {filename: file_sha256(os.path.join(staging_dir, filename))
+                for filename in sorted(zip_file_list)}
+
+
+class BuildPlan:
+    """
+    Class to represent the downloads, zip files and uploads a packaging run would perform.
+    """
+    STAGES = ('download', 'zip', 'upload', 'replicate')
+
+    def __init__(self, title: str):
+        """
+        Initializes an instance of the BuildPlan class.
+
+        Args:
+            title (str): The heading printed above the plan.
+        """
+        self.title = title
+        self.steps: Dict[str, List[Dict[str, Any]]] = {stage: [] for stage in self.STAGES}
+
+    def add(self, stage: str, action: str, name: str, size: int, estimated: bool = False) -> None:
+        # pylint: disable=R0913,R0917
+        """
+        Adds a step to the plan.
+
+        Args:
+            stage (str): One of "download", "zip", "upload" or "replicate".
+            action (str): What would happen, e.g. "download", "cached" or "unchanged".
+            name (str): The file the step applies to.
+            size (int): The number of bytes involved.
+            estimated (bool): Whether the size is an estimate rather than an exact count.
+        """
+        self.steps[stage].append({'action': action, 'name': name, 'size': size,
+                                  'estimated': estimated})
+
+    def transfer_bytes(self, stage: str) -> int:
+        """
+        Returns the number of bytes that would be transferred for a stage.
+
+        Args:
+            stage (str): One of "download", "upload" or "replicate".
 
         Returns:
-            List[Dict[str, str]]: A list of dictionaries,
-            each containing a file name and its corresponding SHA-256 digest.
+            int: The total size of the steps that transfer data.
         """
-        hashes = []
-        for filename in zip_file_list:
-            file_path = os.path.join(PATH_TO_BUCKET_FOLDER, filename)
-            with open(file_path, 'rb') as file_handle:
-                read_bytes = file_handle.read()  # read entire file as bytes
-                readable_hash = hashlib.sha256(read_bytes).hexdigest()
-                hashes.append({filename: readable_hash})
+        return sum(step['size'] for step in self.steps[stage]
+                   if step['action'] not in ('cached', 'unchanged'))
+
+    def print_report(self) -> None:
+        """Prints the plan and the total number of bytes that would be transferred."""
+        print(self.title)
+        for stage in self.STAGES:
+            print(f'{stage.capitalize()}s:')
+            if not self.steps[stage]:
+                print('  (none)')
+            for step in self.steps[stage]:
+                print(f'  {step["action"]:<10} {self._format_size(step):>14}  {step["name"]}')
+        print(f'Total to download: {self.transfer_bytes("download")} bytes')
+        upload_bytes = self.transfer_bytes('upload')
+        estimated = any(step['estimated'] for step in self.steps['upload']
+                        if step['action'] not in ('cached', 'unchanged'))
+        print(f'Total to upload: {"~" if estimated else ""}{upload_bytes} bytes')
+        if self.steps['replicate']:
+            print(f'Total to copy between buckets: {self.transfer_bytes("replicate")} bytes')
+
+    @staticmethod
+    def _format_size(step: Dict[str, Any]) -> str:
+        """Returns the size of a step in bytes, prefixed with ~ if it is an estimate."""
+        return f'{"~" if step["estimated"] else ""}{step["size"]} B'
+
+
+def regional_bucket_name(bucket_name: str, region: str) -> str:
+    """
+    Returns the name of the bucket holding the copy of the package for a region.
 
-        return hashes
+    The name matches the bucket the CloudFormation custom resource uses when
+    UptycsSsmPackageRegionalBuckets is enabled.
+
+    Args:
+        bucket_name (str): The name of the primary S3 bucket.
+        region (str): The name of the AWS region.
+
+    Returns:
+        str: The regional bucket name, "<bucket_name>-<region>".
+
+    Raises:
+        ValueError: If the name is longer than the 63 characters S3 allows.
+    """
+    name = f'{bucket_name}-{region}'
+    if len(name) > 63:
+        raise ValueError(f'The regional bucket name {name} is longer than 63 characters, '
+                         f'use a shorter bucket name')
+    return name
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Generate a SHA-256 digest of a file without reading it into memory in one go.
+
+    Args:
+        file_path (str): The file to generate the digest for.
+        chunk_size (int): The number of bytes to read at a time.
+
+    Returns:
+        str: The hex encoded SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class LogHandler:
@@ -282,13 +814,14 @@ class LogHandler:
         """
         self.logger = logging.getLogger(logger_name)
         self.logger.setLevel(logging.DEBUG)
+        if self.logger.handlers:
+            # Loggers are shared by name, so the handler is only added by the first instance
+            return
         log_format = '%(asctime)s: %(levelname)s: %(name)s: %(message)s'
         filename = os.path.splitext(os.path.basename(__file__))[0] + '.log'
         file_handler = logging.FileHandler(filename)
-        console_handler = logging.StreamHandler()
         formatter = logging.Formatter(log_format)
         file_handler.setFormatter(formatter)
-        console_handler.setFormatter(formatter)
         self.logger.addHandler(file_handler)
 
     def debug(self, msg):
@@ -337,7 +870,27 @@ class LogHandler:
         self.logger.critical(msg)
 
 
-class UptApiAuthError(Exception):
+class UptApiError(Exception):
+    """Base class for exceptions raised when calling the Uptycs API."""
+
+
+class UptApiRequestError(UptApiError):
+    """Exception raised when the Uptycs API responds with an error status."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PackageUploadError(Exception):
+    """Exception raised when the package files could not be uploaded to the S3 bucket."""
+
+
+class ManifestError(Exception):
+    """Exception raised when the package manifest could not be generated."""
+
+
+class UptApiAuthError(UptApiError):
     """Base class for exceptions raised by UptApiAuth."""
 
 
@@ -416,72 +969,118 @@ class UptApiAuth:
         }
 
 
+class UptApiClient:
+    """
+    Class to hold the pooled HTTP session and authorization used for Uptycs API calls.
+
+    One client can be shared by many calls and threads. The authorization is renewed before
+    its token expires, so a client can be kept for the life of a long running process.
+    """
+
+    def __init__(self, api_config_file: str, pool_size: int = 16):
+        """
+        Initializes an instance of the UptApiClient class.
+
+        Args:
+            api_config_file (str): Path to the API key file downloaded from the Uptycs console.
+            pool_size (int): The number of connections kept open to the Uptycs API.
+        """
+        self.api_config_file = api_config_file
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.verify = False
+        self._auth: Optional[UptApiAuth] = None
+        self._auth_time = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def auth(self) -> UptApiAuth:
+        """The API authorization, renewed when half of the token lifetime has passed."""
+        with self._lock:
+            if self._auth is None or time.time() - self._auth_time > TIMEOUT / 2:
+                self._auth = UptApiAuth(self.api_config_file)
+                self._auth_time = time.time()
+            return self._auth
+
+    def call(self, api_endpoint: str, method: str, payload: Optional[Dict] = None,
+             **kwargs) -> 'UptApiCall':
+        """
+        Calls the Uptycs API.
+
+        Args:
+            api_endpoint (str): The Uptycs api endpoint eg '/objectGroups'
+            method (str): The HTTP Method
+            payload (dict): The api payload
+            **kwargs (dict): Additional parameters passed to requests
+
+        Returns:
+            UptApiCall: The completed call.
+        """
+        return UptApiCall(self, api_endpoint, method, payload, **kwargs)
+
+    def close(self) -> None:
+        """Closes the pooled connections."""
+        self.session.close()
+
+
 class UptApiCall:
     # pylint: disable=R0903
     """ Class to call any Uptycs API
         Future enhancement could add support for /url?param=value filters
-        self.rc = 0 on success, 1 on error
     """
 
-    def __init__(self, api_endpoint, method, payload=None, **kwargs):
+    METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+    def __init__(self, client: UptApiClient, api_endpoint, method, payload=None, **kwargs):
         """
 
         Args:
+            client (UptApiClient): The client holding the session and authorization.
             api_endpoint (str): The Uptycs api endpoint eg '/objectGroups'
             method (str): The HTTP Method
             payload (dict): The api payloat
             **kwargs (dict): Additional parameters
+
+        Raises:
+            UptApiAuthError: If the API key file is missing or invalid.
+            UptApiRequestError: If the API responds with an error status.
+            UptApiError: If the API cannot be reached.
         """
         self.logger = LogHandler(str(self.__class__))
-        try:
-            self.api_auth = UptApiAuth(AUTHFILE)
-        except Exception as error: # pylint: disable=W0718
-
-            self.logger.error(error)
-            sys.exit(1)
-
+        self.api_auth = client.auth
         self.items = []  # this can be set by calling get_items() (if method = GET)
 
-        if method == 'GET':
-            response = requests.get(self.api_auth.base_url + api_endpoint,
-                                    headers=self.api_auth.header, verify=False,
-                                    timeout=TIMEOUT,
-                                    **kwargs)
-        elif method == 'POST':
-            payload_json = json.dumps(payload)
-            response = requests.post(self.api_auth.base_url + api_endpoint,
-                                     headers=self.api_auth.header,
-                                     data=payload_json, verify=False,
-                                     timeout=TIMEOUT, **kwargs)
-        elif method == 'PUT':
-            payload_json = json.dumps(payload)
-            response = requests.put(self.api_auth.base_url + api_endpoint,
-                                    headers=self.api_auth.header,
-                                    data=payload_json, verify=False,
-                                    timeout=TIMEOUT, **kwargs)
-        elif method == 'DELETE':
-            payload_json = json.dumps(payload)
-            response = requests.delete(self.api_auth.base_url + api_endpoint,
-                                       headers=self.api_auth.header,
-                                       data=payload_json,
-                                       verify=False, timeout=TIMEOUT, **kwargs)
-        else:
+        if method not in self.METHODS:
+            raise UptApiError(f"Method must be 'GET', 'POST', 'PUT', or 'DELETE'. Supplied "
+                              f"method was: {method}")
+        headers = {**self.api_auth.header, **kwargs.pop('headers', {})}
+        data = json.dumps(payload) if method != 'GET' else None
+        try:
+            response = client.session.request(method, self.api_auth.base_url + api_endpoint,
+                                              headers=headers, data=data, timeout=TIMEOUT,
+                                              **kwargs)
+        except requests.RequestException as err:
             self.logger.error(
-                "Error! Method must be 'GET', 'POST', 'PUT', or 'DELETE'. Supplied method was: "
-                + method)
-            sys.exit(1)
+                "Error during " + method + " on " + api_endpoint + ", base url: " +
+                self.api_auth.base_url)
+            self.logger.error(str(err))
+            raise UptApiError(f'{method} {api_endpoint} failed: {err}') from err
 
         # check response status code, 200 is success
         if response.status_code != 200:
             self.logger.error(
                 "Error during " + method + " on " + api_endpoint + ", base url: " +
                 self.api_auth.base_url)
-            self.logger.error(json.dumps(response.json(), indent=4))
+            self.logger.error(response.text)
+            response.close()
+            raise UptApiRequestError(f'{method} {api_endpoint} failed with HTTP '
+                                     f'{response.status_code}', response.status_code)
 
-        else:
-            self.logger.debug(
-                "Success with " + method + " on " + api_endpoint + ", base url: " +
-                self.api_auth.base_url)
+        self.logger.debug(
+            "Success with " + method + " on " + api_endpoint + ", base url: " +
+            self.api_auth.base_url)
 
         content_type = response.headers.get('Content-Type', '')
         stream_types = ['application/octet-stream', 'application/x-redhat-package-manager']
@@ -501,23 +1100,21 @@ class ObjectGroupsApi:
     ObjectGroupsApi Class
     """
 
-    def __init__(self):
+    def __init__(self, api_client: UptApiClient):
         """
         Class init function setting up logger instance
+
+        Args:
+            api_client (UptApiClient): The client used to call the API.
         """
         self.logger = LogHandler(str(self.__class__))
+        self.api_client = api_client
 
     def object_groups_get(self):
         """
         Get the list of objectGroups.
         """
-
-        try:
-            resp = UptApiCall('/objectGroups', 'GET', {})
-            return resp.response_json
-        except Exception as error: # pylint: disable=W0718:
-            self.logger.error(error)
-            sys.exit(1)
+        return self.api_client.call('/objectGroups', 'GET', {}).response_json
 
     def object_groups_object_group_id_delete(self, object_group_id, **kwargs):
         """
@@ -526,7 +1123,8 @@ class ObjectGroupsApi:
         path = f'/objectGroups/{object_group_id}'
         headers = kwargs.pop('headers', {})
         query_params = kwargs.pop('query_params', {})
-        resp = UptApiCall(path, 'DELETE', headers=headers, query_params=query_params, **kwargs)
+        resp = self.api_client.call(path, 'DELETE', headers=headers, params=query_params,
+                                    **kwargs)
         return resp.response_json
 
 
@@ -535,18 +1133,32 @@ class PackageDownloadsApi:
     Class to handle the download of osquery agents and stage them in local directories.
     """
 
-    def __init__(self):
+    def __init__(self, qos: Optional[TransferQos] = None,
+                 api_client: Optional[UptApiClient] = None,
+                 cache: Optional[ArtifactCache] = None):
         """
         Initializes an instance of PackageDownloadsApi.
+
+        Args:
+            qos (TransferQos, optional): The bandwidth limits applied to downloads.
+            api_client (UptApiClient): The client used to call the API.
+            cache (ArtifactCache, optional): A shared cache checked before calling the API.
         """
+        if api_client is None:
+            raise UptApiError('An UptApiClient is required to download packages')
         self.logger = LogHandler(str(self.__class__))
+        self.qos: TransferQos = qos or TransferQos()
+        self.api_client = api_client
+        self.cache = cache
+        self.expected_payloads: Dict[str, Dict] = {}
+        self.cache_misses: Dict[str, str] = {}
         self.asset_group_id = self._get_asset_group_id()
 
     def _get_asset_group_id(self):
         """
         Retrieves the asset group ID from the Uptrends API.
         """
-        obj_grp_list = ObjectGroupsApi().object_groups_get().get('items')
+        obj_grp_list = ObjectGroupsApi(self.api_client).object_groups_get().get('items')
         for obj_grp in obj_grp_list:
             if obj_grp.get('name') == ASSET_GRP_NAME:
                 return obj_grp.get('id')
@@ -557,7 +1169,7 @@ class PackageDownloadsApi:
         Retrieves the version number of the current osquery packages.
         """
         path = '/osqueryPackages'
-        response = UptApiCall(path, 'GET')
+        response = self.api_client.call(path, 'GET')
 
         # for os_target, arch, version, is_remediation in result:
         #     print(os_target, arch, version, is_remediation)
@@ -565,7 +1177,7 @@ class PackageDownloadsApi:
 
     def package_downloads_osquery_os_asset_group_id_get(self, os_name: str, dir_name: str,
                                                         query_params: Optional[
-                                                            Dict[str, str]] = None) -> None:
+                                                            Dict[str, str]] = None) -> str:
         # pylint: disable=R0914
         """
         Downloads an osquery package for the given os and asset
@@ -575,45 +1187,57 @@ class PackageDownloadsApi:
             os_name (str): The name of the OS, e.g. "debian".
             dir_name (str): The name of the directory to save the package in.
             query_params (Dict[str, str], optional): Additional query parameters for the API call.
+
+        Returns:
+            str: The file name of the downloaded package.
         """
+        # Use the shared artifact cache if it holds the package
+        cache_entry = self.cache and self.cache.entry_prefix(os_name, query_params,
+                                                             self.asset_group_id)
+        if cache_entry:
+            cached = self.cache.fetch(cache_entry, dir_name)
+            if cached:
+                self.expected_payloads[os.path.join(dir_name, cached[0])] = cached[1]
+                return cached[0]
 
         # Construct the API path for the osquery package download
-        path = f'/packageDownloads/osquery/{os_name}/{self.asset_group_id}'
+        path = self._package_download_path(os_name, query_params)
 
         try:
-            # Append any query parameters to the path, if provided
-            if query_params:
-                query_params_str = '&'.join([f'{k}={v}' for k, v in query_params.items()])
-                path += f'?{query_params_str}'
-
-            # Make the API call to download the osquery package
+            # Make the API call to download the osquery package, reading only the headers
             self.logger.debug(f'Calling API with {path}')
-            response = UptApiCall(path, 'GET')
+            response = self.api_client.call(path, 'GET', stream=True)
             self.logger.debug(f'Got response {response.response_stream.status_code}')
 
-            # Extract the filename from the content disposition header
-            content_disp_str = response.response_stream.headers.get('content-disposition', '')
-            file_name = re.findall(r'filename="(.+?)"', content_disp_str)[0]
+            # Extract the filename and size from the response headers
+            file_name, file_size = self._package_file_details(response.response_stream)
+            self.expected_payloads[os.path.join(dir_name, file_name)] = \
+                PayloadVerifier.expected_from_headers(response.response_stream.headers)
+
+            # Skip the download if the same file is already in the directory
+            relative_path = os.path.join(dir_name, file_name)
+            if cache_entry:
+                self.cache_misses[relative_path] = cache_entry
+            if os.path.isfile(relative_path) and os.path.getsize(relative_path) == file_size:
+                response.response_stream.close()
+                print(f'Already downloaded {relative_path} - Skipping download')
+                return file_name
 
             # Download and save the osquery package to the specified directory
             self.logger.debug(f'Downloading file {file_name}')
-            relative_path = f'./{dir_name}/{file_name}'
-            os.makedirs(os.path.dirname(relative_path), exist_ok=True)
-            if response.response_stream.status_code == 200:
-                with open(relative_path, 'wb') as file_handle:
-                    for chunk in response.response_stream.iter_content(1024):
-                        file_handle.write(chunk)
+            os.makedirs(dir_name, exist_ok=True)
+            with open(relative_path, 'wb') as file_handle:
+                for chunk in response.response_stream.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    self.qos.consume(DOWNLOAD, len(chunk))
+                    file_handle.write(chunk)
             print(f'Successfully wrote to folder {relative_path}')
+            return file_name
 
-            # Replace the filename in the install script with the downloaded package filename
-            install_file_name = 'install.ps1' if os_name == 'windows' else 'install.sh'
-            install_file_path = f'./{dir_name}/{install_file_name}'
-            with open(install_file_path, "r", encoding="utf-8") as file:
-                content = file.read()
-            content = re.sub(r"(filename=|\$filename=)[^\n]+", r"\g<1>" + file_name, content)
-            with open(install_file_path, "w", encoding="utf-8") as file:
-                file.write(content)
-
+        except requests.RequestException as error:
+            # The connection failed while the package was being read
+            self.logger.error(f'Error during GET on {path}')
+            self.logger.error(str(error))
+            raise UptApiError(f'GET {path} failed: {error}') from error
         except Exception as error:
             # Log and raise any errors encountered during the osquery package download
             self.logger.error(f'Error during GET on {path}')
@@ -621,62 +1245,249 @@ class PackageDownloadsApi:
             raise error
 
 
+    def package_downloads_osquery_os_asset_group_id_head(
+            self, os_name: str, query_params: Optional[Dict[str, str]] = None) -> Tuple[str, int]:
+        """
+        Looks up the file name and size of an osquery package without downloading it.
+
+        Args:
+            os_name (str): The name of the OS, e.g. "debian".
+            query_params (Dict[str, str], optional): Additional query parameters for the API call.
+
+        Returns:
+            Tuple[str, int]: The file name and size in bytes of the package.
+        """
+        path = self._package_download_path(os_name, query_params)
+        self.logger.debug(f'Calling API with {path}')
+        response = self.api_client.call(path, 'GET', stream=True)
+        try:
+            return self._package_file_details(response.response_stream)
+        finally:
+            response.response_stream.close()
+
+    def _package_download_path(self, os_name: str,
+                               query_params: Optional[Dict[str, str]] = None) -> str:
+        """
+        Returns the API path used to download an osquery package.
+
+        Args:
+            os_name (str): The name of the OS, e.g. "debian".
+            query_params (Dict[str, str], optional): Additional query parameters for the API call.
+
+        Returns:
+            str: The API path including any query parameters.
+        """
+        path = f'/packageDownloads/osquery/{os_name}/{self.asset_group_id}'
+        if query_params:
+            query_params_str = '&'.join([f'{k}={v}' for k, v in query_params.items()])
+            path += f'?{query_params_str}'
+        return path
+
+    @staticmethod
+    def _package_file_details(response: requests.Response) -> Tuple[str, int]:
+        """
+        Extracts the package file name and size from the download response headers.
+
+        Args:
+            response (requests.Response): The streamed download response.
+
+        Returns:
+            Tuple[str, int]: The file name and size in bytes, -1 if the size was not sent.
+        """
+        content_disp_str = response.headers.get('content-disposition', '')
+        file_name = re.findall(r'filename="(.+?)"', content_disp_str)[0]
+        return file_name, int(response.headers.get('content-length', -1))
+
+
 class ManagePackageBucket:
     # pylint: disable=R0903
     """
     Class to handle all interactions with the S3 Bucket used for the distributor package
     """
 
-    def __init__(self, region_name: str) -> None:
+    def __init__(self, region_name: str, qos: Optional[TransferQos] = None,
+                 staging_dir: str = PATH_TO_BUCKET_FOLDER, s3_client=None) -> None:
         """
         Initializes an instance of the ManagePackageBucket class.
 
         Args:
             region_name (str): The name of the AWS region.
+            qos (TransferQos, optional): The bandwidth and concurrency limits for uploads.
+            staging_dir (str): The directory holding the files to upload.
+            s3_client (S3.Client, optional): The S3 client to use. A new client is created for
+                the region if not set.
         """
         self.logger = LogHandler(str(self.__class__))
+        self.qos: TransferQos = qos or TransferQos()
         self.region = region_name
-        self.s3_client = boto3.client('s3', region_name=self.region)
+        self.staging_dir = staging_dir
+        self.s3_client = s3_client or boto3.client('s3', region_name=self.region)
 
-    def update(self, bucket_name: str, file_list: set) -> bool:
+    def update(self, bucket_name: str, file_list: set,
+               source_bucket: Optional[str] = None) -> bool:
         """
         Updates the bucket contents.
 
+        Up to qos.upload_concurrency files are uploaded at the same time. The manifest is
+        uploaded last so that it never refers to a zip file that is not in the bucket yet.
+
         Args:
             bucket_name (str): The name of the S3 bucket.
             file_list (list[str]): A list of file names to be uploaded.
+            source_bucket (str, optional): A bucket already holding the files. If set, the
+                files are copied from it within S3 instead of being uploaded from the staging
+                directory.
 
         Returns:
             bool: True if the update was successful, else False.
         """
-        if not self._bucket_exists(bucket_name):
+        bucket_exists = self._bucket_exists(bucket_name)
+        if not bucket_exists:
             self._create_bucket(bucket_name)
-        for file in file_list:
-            file_path = os.path.join(PATH_TO_BUCKET_FOLDER, file)
+        uploads = []
+        for file in sorted(file_list, key=lambda name: (name == 'manifest.json', name)):
+            file_path = os.path.join(self.staging_dir, file)
             object_key = f"{S3PREFIX}/{file}"
-            self._upload_file(file_path, bucket_name, object_key)
-        return True
+            file_digest = file_sha256(file_path)
+            if bucket_exists and self.object_sha256(bucket_name, object_key) == file_digest:
+                print(f'File {object_key} is unchanged - Skipping upload')
+                continue
+            uploads.append((source_bucket or file_path, bucket_name, object_key, file_digest))
+
+        transfer = self._copy_object if source_bucket else self._upload_file
+        manifest = [upload for upload in uploads if upload[2].endswith('/manifest.json')]
+        with ThreadPoolExecutor(max_workers=self.qos.upload_concurrency) as executor:
+            results = list(executor.map(lambda upload: transfer(*upload),
+                                        [upload for upload in uploads if upload not in manifest]))
+        if all(results):
+            results += [transfer(*upload) for upload in manifest]
+        if not source_bucket:
+            print(self.qos.summary(UPLOAD))
+        return all(results)
+
+    def plan_update(self, bucket_name: str, uploads: Dict[str, Tuple[int, bool, bool]],
+                    build_plan: BuildPlan, stage: str = 'upload') -> None:
+        """
+        Adds the uploads that update() would perform to a build plan.
 
-    def _bucket_exists(self, bucket_name: str) -> bool:
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+            uploads (Dict[str, Tuple[int, bool, bool]]): For each file name, its size, whether
+                the size is an estimate and whether the local file will change before upload.
+            build_plan (BuildPlan): The plan to add the uploads to.
+            stage (str): The plan stage, "upload" or "replicate" for copies within S3.
         """
-        Checks that the S3 bucket exists in the region.
+        bucket_exists = self._head_bucket(bucket_name) == '200'
+        for file, (size, estimated, changed) in sorted(uploads.items()):
+            object_key = f"{S3PREFIX}/{file}"
+            remote_digest = self.object_sha256(bucket_name, object_key) \
+                if bucket_exists else None
+            if remote_digest is None:
+                action = 'new'
+            elif not changed and remote_digest == file_sha256(
+                    os.path.join(self.staging_dir, file)):
+                action = 'unchanged'
+            else:
+                action = 'replace'
+            build_plan.add(stage, action, f's3://{bucket_name}/{object_key}', size, estimated)
+
+    def object_sha256(self, bucket_name: str, object_key: str) -> Optional[str]:
+        """
+        Returns the SHA-256 digest recorded when an object was uploaded.
 
         Args:
             bucket_name (str): The name of the S3 bucket.
+            object_key (str): The S3 object key.
 
         Returns:
-            bool: True if the bucket exists, else False.
+            Optional[str]: The digest, an empty string if the object has no recorded digest or
+            None if the object does not exist.
         """
         try:
-            response = self.s3_client.list_buckets()
-            for bucket in response['Buckets']:
-                if bucket_name == bucket["Name"]:
-                    print('Bucket already exists -Skipping Creation:')
-                    return True
-            return False
+            response = self.s3_client.head_object(Bucket=bucket_name, Key=object_key)
+            return response.get('Metadata', {}).get('sha256', '')
         except ClientError as err:
-            self.logger.error(f'Error listing buckets {err}')
+            if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def check_bucket(self, bucket_name: str, read_only: bool = False) -> str:
+        """
+        Checks that the bucket can be used for the package without uploading any package files.
+
+        A bucket that does not exist yet passes, as it will be created in the region. An existing
+        bucket must be in the region and, unless read_only is set, accept a test object under the
+        S3 prefix.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+            read_only (bool): Whether to only read the bucket, without the test object.
+
+        Returns:
+            str: A description of the bucket status.
+
+        Raises:
+            PreflightFailure: If the bucket is owned by another account, is in a different
+                region or cannot be written to.
+        """
+        status = self._head_bucket(bucket_name)
+        if status == '404':
+            return f'{bucket_name} does not exist and will be created in {self.region}'
+        if status != '200':
+            raise PreflightFailure(f'{bucket_name} is not accessible (HTTP {status})')
+
+        location = self.s3_client.get_bucket_location(Bucket=bucket_name)
+        bucket_region = location.get('LocationConstraint') or 'us-east-1'
+        if bucket_region != self.region:
+            raise PreflightFailure(f'{bucket_name} is in {bucket_region}, not {self.region}')
+        if read_only:
+            return f'{bucket_name} exists in {self.region}'
+
+        object_key = f'{S3PREFIX}/.preflight'
+        try:
+            self.s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=b'')
+        except ClientError as err:
+            raise PreflightFailure(f'Unable to write to {bucket_name}: {err}') from err
+        try:
+            self.s3_client.delete_object(Bucket=bucket_name, Key=object_key)
+        except ClientError as err:
+            self.logger.warning(f'Unable to remove {object_key} from {bucket_name}: {err}')
+        return f'{bucket_name} exists in {self.region} and is writable'
+
+    def _head_bucket(self, bucket_name: str) -> str:
+        """
+        Looks up a single bucket rather than listing every bucket in the account.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+
+        Returns:
+            str: The HTTP status code of the HeadBucket call, e.g. "200", "403" or "404".
+        """
+        try:
+            self.s3_client.head_bucket(Bucket=bucket_name)
+            return '200'
+        except ClientError as err:
+            return str(err.response.get('Error', {}).get('Code', 'unknown'))
+
+    def _bucket_exists(self, bucket_name: str) -> bool:
+        """
+        Checks that the S3 bucket exists.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+
+        Returns:
+            bool: True if the bucket exists, else False.
+        """
+        status = self._head_bucket(bucket_name)
+        if status == '404':
             return False
+        if status == '200':
+            print('Bucket already exists -Skipping Creation:')
+        else:
+            self.logger.error(f'Error checking bucket {bucket_name}: HTTP {status}')
+        return True
 
     def _create_bucket(self, bucket_name: str) -> bool:
         """
@@ -704,23 +1515,27 @@ class ManagePackageBucket:
             self.logger.error(f'Error creating bucket {err}')
             return False
 
-    def _upload_file(self, file_path: str, bucket_name: str, object_key: str) -> bool:
+    def _upload_file(self, file_path: str, bucket_name: str, object_key: str,
+                     file_digest: str) -> bool:
         """Upload a file to an S3 bucket
 
         :param file_path: File to upload
         :param bucket_name: Bucket to upload to
         :param object_key: S3 object key
+        :param file_digest: SHA-256 digest of the file, stored in the object metadata
         :return: True if file was uploaded, else False
         """
         try:
             start_time = time.time()
             print(f'Uploading file {file_path}:')
-            with open(file_path, "rb") as content:
-                self.s3_client.put_object(
-                    Bucket=bucket_name,
-                    Key=object_key,
-                    Body=content
-                )
+            self.s3_client.upload_file(
+                file_path,
+                bucket_name,
+                object_key,
+                ExtraArgs={'Metadata': {'sha256': file_digest}},
+                Callback=self.qos.callback(UPLOAD),
+                Config=TransferConfig(use_threads=False)
+            )
             time_taken = time.time() - start_time
             print(f"Successfully finished uploading files to s3 bucket. in {time_taken}s")
             return True
@@ -728,15 +1543,354 @@ class ManagePackageBucket:
             self.logger.error(f'Upload error {err}')
             return False
 
+    def _copy_object(self, source_bucket: str, bucket_name: str, object_key: str,
+                     file_digest: str) -> bool:
+        """Copy an object from another bucket within S3, keeping its metadata
 
-def main():
+        The copy is only made if the SHA-256 digest recorded in the source object's metadata
+        matches the staged file, and only from the version of the object that was checked.
+
+        :param source_bucket: Bucket holding the object, which may be in another region
+        :param bucket_name: Bucket to copy to
+        :param object_key: S3 object key, the same in both buckets
+        :param file_digest: SHA-256 digest of the staged file the source object must match
+        :return: True if the object was copied, else False
+        """
+        try:
+            print(f'Copying s3://{source_bucket}/{object_key} to {bucket_name}:')
+            source = self.s3_client.head_object(Bucket=source_bucket, Key=object_key)
+            source_digest = source.get('Metadata', {}).get('sha256')
+            if source_digest != file_digest:
+                self.logger.error(f'Copy error s3://{source_bucket}/{object_key} has SHA-256 '
+                                  f'{source_digest}, expected {file_digest}')
+                return False
+            self.s3_client.copy_object(
+                Bucket=bucket_name,
+                Key=object_key,
+                CopySource={'Bucket': source_bucket, 'Key': object_key},
+                CopySourceIfMatch=source['ETag']
+            )
+            return True
+        except (BotoCoreError, ClientError) as err:
+            self.logger.error(f'Copy error {err}')
+            return False
+
+
+class PackagingClients:
     """
+    Class to hold the Uptycs API and S3 clients shared by packaging runs.
 
-    Main function
+    The clients pool their connections, so a process that runs many builds pays the connection
+    and authorization setup once. Clients are thread safe and can be shared by concurrent
+    builds.
+    """
+
+    def __init__(self, api_config_file: Optional[str] = None, pool_size: int = 16):
+        """
+        Initializes an instance of the PackagingClients class.
 
+        Args:
+            api_config_file (str, optional): Path to the API key file downloaded from the
+                Uptycs console. Only needed to call the Uptycs API.
+            pool_size (int): The number of connections each client keeps open.
+        """
+        self.api_config_file = api_config_file
+        self.pool_size = pool_size
+        self._api: Optional[UptApiClient] = None
+        self._aws_clients: Dict[Tuple[str, str, Optional[str]], Any] = {}
+        self._session = boto3.session.Session()
+        self._lock = threading.Lock()
+
+    @property
+    def api(self) -> UptApiClient:
+        """The Uptycs API client."""
+        if self.api_config_file is None:
+            raise ApiConfigFileNotFoundError('An API config file is required to call the '
+                                             'Uptycs API')
+        with self._lock:
+            if self._api is None:
+                self._api = UptApiClient(self.api_config_file, self.pool_size)
+            return self._api
+
+    def s3(self, region_name: str, endpoint_url: Optional[str] = None):
+        """
+        Returns the S3 client for a region.
+
+        Args:
+            region_name (str): The name of the AWS region.
+            endpoint_url (str, optional): The endpoint of an S3-compatible store to use
+                instead of AWS.
+
+        Returns:
+            S3.Client: The S3 client.
+        """
+        return self._aws_client('s3', region_name, endpoint_url)
+
+    def ssm(self, region_name: str):
+        """
+        Returns the SSM client for a region.
+
+        Args:
+            region_name (str): The name of the AWS region.
+
+        Returns:
+            SSM.Client: The SSM client.
+        """
+        return self._aws_client('ssm', region_name)
+
+    def _aws_client(self, service_name: str, region_name: str,
+                    endpoint_url: Optional[str] = None):
+        """Returns the cached client of an AWS service for a region, creating it if needed."""
+        with self._lock:
+            key = (service_name, region_name, endpoint_url)
+            if key not in self._aws_clients:
+                self._aws_clients[key] = self._session.client(
+                    service_name, region_name=region_name, endpoint_url=endpoint_url,
+                    config=botocore.config.Config(max_pool_connections=self.pool_size))
+            return self._aws_clients[key]
+
+    def close(self) -> None:
+        """Closes the pooled connections."""
+        if self._api is not None:
+            self._api.close()
+
+
+def run_preflight_checks(clients: PackagingClients, s3_bucket: str, region: str,
+                         package_version: Optional[str], use_api: bool,
+                         staging_dir: str = PATH_TO_BUCKET_FOLDER,
+                         replica_regions: Sequence[str] = (),
+                         min_free_bytes: int = MIN_FREE_DISK_BYTES, plan: bool = False) -> bool:
+    # pylint: disable=R0913,R0914,R0917
+    """
+    Runs the preflight checks concurrently and prints the results.
+
+    Args:
+        clients (PackagingClients): The Uptycs API and S3 clients.
+        s3_bucket (str): The name of the S3 bucket the package will be uploaded to.
+        region (str): The AWS region of the bucket.
+        package_version (str, optional): The osquery version requested, None for the latest.
+        use_api (bool): Whether the run will use the Uptycs API.
+        staging_dir (str): The directory the zip files will be written to.
+        replica_regions (Sequence[str]): The regions the package will be copied to.
+        min_free_bytes (int): The free disk space required, 0 to skip the disk space check.
+        plan (bool): Whether this is a --plan run. It writes nothing, so the buckets are only
+            read and the disk space check is skipped.
+
+    Returns:
+        bool: True if every check passed, else False.
+    """
+    api_config_file = clients.api_config_file or ''
+    api_config = os.path.abspath(api_config_file)
+    api_config_key = f'{api_config}:{os.path.getmtime(api_config_file)}' \
+        if os.path.isfile(api_config_file) else None
+
+    def check_api_credentials() -> str:
+        return f'API key file is valid for {clients.api.auth.base_url}'
+
+    def check_asset_group() -> str:
+        response = clients.api.call('/objectGroups', 'GET').response_json
+        if 'items' not in response:
+            raise PreflightFailure('the API request was rejected, check the API credentials')
+        for obj_grp in response['items']:
+            if obj_grp.get('name') == ASSET_GRP_NAME:
+                return f'asset group {ASSET_GRP_NAME} has id {obj_grp.get("id")}'
+        raise PreflightFailure(f'asset group {ASSET_GRP_NAME} was not found')
+
+    def check_version() -> str:
+        response = clients.api.call('/osqueryPackages', 'GET').response_json
+        if 'items' not in response:
+            raise PreflightFailure('the API request was rejected, check the API credentials')
+        versions = [item['version'].split('-')[0] for item in response['items']]
+        if not versions:
+            raise PreflightFailure('no osquery packages are available')
+        if package_version is None:
+            return f'latest osquery version is {versions[0]}'
+        if package_version not in versions:
+            raise PreflightFailure(f'osquery version {package_version} is not available')
+        return f'osquery version {package_version} is available'
+
+    access = 'read' if plan else 'write'
+    checks = [
+        PreflightCheck('S3 bucket', lambda: ManagePackageBucket(
+            region, s3_client=clients.s3(region)).check_bucket(s3_bucket, plan),
+                       f'{s3_bucket}:{region}:{access}')
+    ]
+    if min_free_bytes > 0 and not plan:
+        checks.append(PreflightCheck('Disk space', lambda: check_free_disk_space(
+            ['.', staging_dir], min_free_bytes)))
+    for replica_region in replica_regions:
+        replica = regional_bucket_name(s3_bucket, replica_region)
+        checks.append(PreflightCheck(
+            f'S3 bucket {replica_region}',
+            lambda name=replica, where=replica_region: ManagePackageBucket(
+                where, s3_client=clients.s3(where)).check_bucket(name, plan),
+            f'{replica}:{replica_region}:{access}'))
+    if use_api:
+        checks = [
+            PreflightCheck('API credentials', check_api_credentials, api_config_key),
+            PreflightCheck('Asset group', check_asset_group,
+                           api_config_key and f'{api_config_key}:{ASSET_GRP_NAME}'),
+            PreflightCheck('osquery version', check_version,
+                           package_version and api_config_key and
+                           f'{api_config_key}:{package_version}')
+        ] + checks
+
+    print('Running preflight checks')
+    results = PreflightRunner().run(checks)
+    for result in results:
+        print(result)
+    return all(result.passed for result in results)
+
+
+def latest_version(clients: PackagingClients) -> str:
+    """
+    Returns the latest osquery version available from the Uptycs API.
+
+    Args:
+        clients (PackagingClients): The Uptycs API and S3 clients.
+
+    Returns:
+        str: The osquery version, e.g. "5.7.0.25".
+    """
+    return PackageDownloadsApi(api_client=clients.api).osquery_packages_get_version()
+
+
+def build_package(clients: PackagingClients, bucket_name: str, region: str,
+                  version: Optional[str] = None, with_remediation: bool = True,
+                  download: bool = True, replica_regions: Sequence[str] = (),
+                  **options) -> DistributorFilePackager:
+    # pylint: disable=R0913,R0917
+    """
+    Builds the Distributor package and uploads it to the S3 bucket.
+
+    The installers are downloaded (or the installers added manually are verified), then the
+    zip files and manifest are created and uploaded.
+
+    Args:
+        clients (PackagingClients): The Uptycs API and S3 clients.
+        bucket_name (str): The name of the S3 bucket.
+        region (str): The AWS region of the bucket.
+        version (str, optional): The osquery version, the latest version if not set.
+        with_remediation (bool): Whether to include the remediation package.
+        download (bool): Whether to download the installers from the Uptycs API.
+        replica_regions (Sequence[str]): The regions to copy the package to, each into the
+            bucket named by regional_bucket_name().
+        **options: Passed to DistributorFilePackager, e.g. qos, checksum_catalog, source_dir
+            and staging_dir.
+
+    Returns:
+        DistributorFilePackager: The packager, holding the manifest and zip file list.
+
+    Raises:
+        UptApiError: If a call to the Uptycs API fails.
+        AgentMappingError: If the agent mapping file is invalid.
+        PayloadVerificationError: If an installer fails verification.
+        ManifestError: If the package manifest could not be generated.
+        PackageUploadError: If the package files could not be uploaded.
+    """
+    packager = DistributorFilePackager(version or latest_version(clients), with_remediation,
+                                       clients=clients, **options)
+    if download:
+        packager.download_osquery_files()
+    else:
+        packager.verify_payloads()
+        packager.update_install_checksums()
+    packager.create_staging_dir()
+    packager.add_files_to_bucket(bucket_name, region, replica_regions)
+    return packager
+
+
+def plan_package(clients: PackagingClients, bucket_name: str, region: str,
+                 version: Optional[str] = None, with_remediation: bool = True,
+                 download: bool = True, replica_regions: Sequence[str] = (),
+                 **options) -> BuildPlan:
+    # pylint: disable=R0913,R0917
+    """
+    Works out what build_package would transfer without transferring any package files.
+
+    Args:
+        clients (PackagingClients): The Uptycs API and S3 clients.
+        bucket_name (str): The name of the S3 bucket.
+        region (str): The AWS region of the bucket.
+        version (str, optional): The osquery version, the latest version if not set.
+        with_remediation (bool): Whether to include the remediation package.
+        download (bool): Whether the installers would be downloaded from the Uptycs API.
+        replica_regions (Sequence[str]): The regions the package would be copied to.
+        **options: Passed to DistributorFilePackager.
+
+    Returns:
+        BuildPlan: The steps of the run with their sizes in bytes.
+    """
+    packager = DistributorFilePackager(version or latest_version(clients), with_remediation,
+                                       clients=clients, **options)
+    return packager.plan(bucket_name, region, download, replica_regions)
+
+
+def apply_retention(clients: PackagingClients, bucket_name: str, region: str,
+                    keep_versions: int, current_version: Optional[str] = None,
+                    package_name: str = PACKAGE_NAME, replica_regions: Sequence[str] = (),
+                    document_regions: Optional[Sequence[str]] = None,
+                    dry_run: bool = False) -> RetentionPlan:
+    # pylint: disable=R0913,R0917
+    """
+    Removes old package versions from the bucket and its regional copies, and deletes the stale
+    versions of the Distributor document.
+
+    Args:
+        clients (PackagingClients): The S3 and SSM clients.
+        bucket_name (str): The name of the S3 bucket.
+        region (str): The AWS region of the bucket.
+        keep_versions (int): The number of package versions to keep.
+        current_version (str, optional): The package version being published, always kept.
+        package_name (str): The name of the Distributor document.
+        replica_regions (Sequence[str]): The regions the package was copied to.
+        document_regions (Sequence[str], optional): The regions the Distributor document is
+            published in. Defaults to the bucket region and the replica regions.
+        dry_run (bool): Whether to only work out what would be deleted.
+
+    Returns:
+        RetentionPlan: What was, or with dry_run would be, kept and deleted.
+
+    Raises:
+        RetentionError: If a document version or object could not be deleted.
+    """
+    buckets = {bucket_name: clients.s3(region)}
+    for replica_region in replica_regions:
+        buckets[regional_bucket_name(bucket_name, replica_region)] = clients.s3(replica_region)
+    ssm_clients = {document_region: clients.ssm(document_region) for document_region in
+                   dict.fromkeys(document_regions or [region, *replica_regions])}
+    retention = PackageRetention(ssm_clients, package_name, keep_versions, S3PREFIX)
+    plan = retention.plan(buckets, current_version)
+    if not dry_run:
+        retention.apply(plan, buckets)
+    return plan
+
+
+async def latest_version_async(clients: PackagingClients) -> str:
+    """Runs latest_version in a worker thread."""
+    return await asyncio.to_thread(latest_version, clients)
+
+
+async def build_package_async(*args, **kwargs) -> DistributorFilePackager:
+    """
+    Runs build_package in a worker thread so that an event loop can run several builds at once.
+    Each concurrent build needs its own source_dir and staging_dir.
+    """
+    return await asyncio.to_thread(build_package, *args, **kwargs)
+
+
+async def plan_package_async(*args, **kwargs) -> BuildPlan:
+    """Runs plan_package in a worker thread."""
+    return await asyncio.to_thread(plan_package, *args, **kwargs)
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parses and validates the command line options.
+
+    Returns:
+        argparse.Namespace: The options.
     """
-    # pylint: disable=W0603
-    global AUTHFILE
     parser = argparse.ArgumentParser(
         description='Create and upload Distributor packages to the AWS SSM'
     )
@@ -748,9 +1902,11 @@ def main():
                              'If not set the bucket will have the name format '
                              'uptycs-dist- + random_string')
     parser.add_argument('-p', '--package_name', default='UptycsAgent',
-                        help='OPTIONAL: Use with -d to specify the name of the Distributor '
-                             'Package that you will create using files .rpm and .deb files that '
-                             'you have added manually')
+                        help='OPTIONAL: The name of the Distributor Package document. Use with '
+                             '-d to name a package you create using .rpm and .deb files that '
+                             'you have added manually. It is also the document that '
+                             '--retain_versions checks and prunes, so set it to the '
+                             'UptycsSsmPackageName of the stack if that is not UptycsAgent')
     parser.add_argument('-r', '--aws_region', default='us-east-1',
                         help='OPTIONAL: The AWS Region that the Bucket will be created in')
     parser.add_argument('-v', '--package_version', default=None,
@@ -765,48 +1921,137 @@ def main():
                         default=False,
                         help='OPTIONAL: Setup package without Uptycs protect.  By default the '
                              'Uptycs Protect agent will be used')
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help='OPTIONAL: Print the downloads, zip files and uploads that would be '
+                             'performed, with their sizes, without transferring any package files')
+    parser.add_argument('--max_bandwidth', type=float, default=None,
+                        help='OPTIONAL: Combined bandwidth cap for downloads and uploads in MiB/s')
+    parser.add_argument('--download_bandwidth', type=float, default=None,
+                        help='OPTIONAL: Bandwidth cap for downloads from the Uptycs API in MiB/s')
+    parser.add_argument('--upload_bandwidth', type=float, default=None,
+                        help='OPTIONAL: Bandwidth cap for uploads to the S3 bucket in MiB/s')
+    parser.add_argument('--download_concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='OPTIONAL: Number of packages downloaded from the Uptycs API at the '
+                             'same time')
+    parser.add_argument('--upload_concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='OPTIONAL: Number of files uploaded to the S3 bucket at the same time')
+    parser.add_argument('--checksum_catalog', default=None,
+                        help='OPTIONAL: JSON file mapping each installer file name to its trusted '
+                             'SHA-256 digest. Installers that are missing or do not match are '
+                             'quarantined and the run is aborted')
+    parser.add_argument('--replica_regions', type=lambda value: [
+        region.strip() for region in value.split(',') if region.strip()], default=[],
+                        help='OPTIONAL: Comma separated list of regions to copy the package to. '
+                             'Each region gets a bucket named <s3bucket>-<region> for use with '
+                             'the UptycsSsmPackageRegionalBuckets stack parameter')
+    parser.add_argument('--retain_versions', type=int, default=None,
+                        help='OPTIONAL: After the upload, delete all but this number of package '
+                             'versions from the bucket and its regional copies, keeping any '
+                             'version used by a live document version, and delete the stale '
+                             'document versions. With --plan the deletions are only reported')
+    parser.add_argument('--document_regions', type=lambda value: [
+        region.strip() for region in value.split(',') if region.strip()], default=None,
+                        help='OPTIONAL: Comma separated list of regions the Distributor document '
+                             'is published in, checked by --retain_versions. Defaults to the '
+                             'bucket region and --replica_regions')
+    parser.add_argument('--cache_url', default=None,
+                        help='OPTIONAL: Shared cache of installers in the form s3://bucket/prefix, '
+                             'read before the Uptycs API and populated with each verified '
+                             'download')
+    parser.add_argument('--cache_endpoint_url', default=None,
+                        help='OPTIONAL: Endpoint of an S3-compatible store holding --cache_url, '
+                             'e.g. http://localhost:9000')
+    parser.add_argument('--cache_region', default=None,
+                        help='OPTIONAL: Region of the --cache_url bucket. Defaults to '
+                             '-r/--aws_region')
+    parser.add_argument('--min_free_space', type=float, default=MIN_FREE_DISK_BYTES / 1024 ** 3,
+                        help='OPTIONAL: Free disk space in GiB the preflight checks require, '
+                             '0 to skip the check (default: 2)')
+    parser.add_argument('--skip_preflight', action='store_true', default=False,
+                        help='OPTIONAL: Skip the checks of the API credentials, asset group, '
+                             'osquery version, S3 bucket and free disk space that run before '
+                             'any files are downloaded')
+    add_profiler_arguments(parser)
     args = parser.parse_args()
     if args.download is False and (args.package_version is None or args.package_name is None):
         parser.error('-v/--package_version and -p/--package_name are mandatory with -d/--download '
                      'flag')
+    if args.min_free_space < 0:
+        parser.error('--min_free_space must not be negative')
+    if args.retain_versions is not None and args.retain_versions < 1:
+        parser.error('--retain_versions must be at least 1')
+    if args.cache_url and not CACHE_URL_PATTERN.match(args.cache_url):
+        parser.error('--cache_url must be in the form s3://bucket/prefix')
+    return args
+
 
+def main():
+    """
+
+    Main function
+
+    """
+    args = parse_arguments()
     region = args.aws_region
     package_version: Optional[Any] = args.package_version
-    AUTHFILE = args.config
-    download_files = args.download
     random_string = ''.join(random.sample(string.ascii_lowercase, 6))
 
-    if args.sensor_only:
-        upt_protection = 'false'
-    else:
-        upt_protection = 'true'
-
     if args.s3bucket is None:
         s3_bucket = 'uptycs-dist-' + random_string
     else:
         s3_bucket = args.s3bucket
 
-    if package_version:
+    clients = PackagingClients(args.config)
+    profiler = StageProfiler(args.profile_dir, args.profile, args.trace_memory)
+    profiler.instrument(DistributorFilePackager, ['_add_binary_to_dir', '_create_zip_files',
+                                                  '_generate_digest', '_generate_manifest'])
+    profiler.instrument(ManagePackageBucket, ['update'])
+    try:
+        if not args.skip_preflight and not run_preflight_checks(
+                clients, s3_bucket, region, package_version, args.download or not package_version,
+                replica_regions=args.replica_regions,
+                min_free_bytes=int(args.min_free_space * 1024 ** 3), plan=args.plan):
+            print('Preflight checks failed')
+            sys.exit(1)
+
         #
-        # Get the osquery version available via the Uptycs API
+        # Initialise the Distributor package object for this version
         #
-        version = args.package_version
-    else:
-        version = PackageDownloadsApi().osquery_packages_get_version()
-    #
-    # Initialise the Distributor package object for this version
-    #
-    uptycs_packager = DistributorFilePackager(version, upt_protection)
-    #
-    # (Optional) Download the osquery binaries from the Uptycs API
-    # You can add older versions of the files manually.
-    if download_files:
-        uptycs_packager.download_osquery_files()
-    #
-    # Generate the zip file and manifest and add them to the local staging folder
-    #
-    uptycs_packager.create_staging_dir()
-    uptycs_packager.add_files_to_bucket(s3_bucket, region)
+        qos = TransferQos(
+            max_bandwidth=args.max_bandwidth and args.max_bandwidth * MIB,
+            stage_bandwidth={
+                DOWNLOAD: args.download_bandwidth and args.download_bandwidth * MIB,
+                UPLOAD: args.upload_bandwidth and args.upload_bandwidth * MIB
+            },
+            download_concurrency=args.download_concurrency,
+            upload_concurrency=args.upload_concurrency)
+        cache = ArtifactCache(args.cache_url, clients.s3(args.cache_region or region,
+                                                         args.cache_endpoint_url),
+                              qos) if args.cache_url else None
+        if args.retain_versions:
+            package_version = package_version or latest_version(clients)
+        if args.plan:
+            plan_package(clients, s3_bucket, region, package_version, not args.sensor_only,
+                         args.download, args.replica_regions, qos=qos,
+                         checksum_catalog=args.checksum_catalog, cache=cache).print_report()
+        else:
+            build_package(clients, s3_bucket, region, package_version, not args.sensor_only,
+                          args.download, args.replica_regions, qos=qos,
+                          checksum_catalog=args.checksum_catalog, cache=cache)
+        if args.retain_versions:
+            retention_plan = apply_retention(
+                clients, s3_bucket, region, args.retain_versions, package_version,
+                args.package_name, args.replica_regions, args.document_regions, args.plan)
+            if args.plan:
+                retention_plan.print_report()
+    except (UptApiError, PayloadVerificationError, ManifestError, PackageUploadError,
+            RetentionError, AgentMappingError, ValueError, OSError, BotoCoreError,
+            ClientError) as error:
+        print(error)
+        sys.exit(1)
+    finally:
+        profiler.close()
+        clients.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,278 @@
+"""
+Removes old package versions from the S3 buckets and stale versions of the Distributor document
+"""
+
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+DELETE_BATCH_SIZE = 1000
+DEFAULT_WORKERS = 8
+ZIP_NAME_PATTERN = re.compile(r'^(?P<dir>[^/]+)-(?P<version>[^-/]+)\.zip$')
+
+
+class RetentionError(Exception):
+    """Exception raised when old package files or document versions could not be removed."""
+
+
+def version_key(version: str) -> Tuple:
+    """
+    Returns a sort key that orders versions numerically, e.g. 5.10.0.1 after 5.9.0.3.
+
+    Args:
+        version (str): The version string.
+
+    Returns:
+        Tuple: The sort key.
+    """
+    return tuple((0, int(part), '') if part.isdigit() else (1, 0, part)
+                 for part in re.split(r'[.\-_]', version))
+
+
+class RetentionPlan:
+    """
+    Class to represent the objects and document versions a retention run keeps and removes.
+    """
+
+    def __init__(self, package_name: str, retained_versions: List[str]):
+        """
+        Initializes an instance of the RetentionPlan class.
+
+        Args:
+            package_name (str): The name of the Distributor package.
+            retained_versions (List[str]): The package versions kept, newest first.
+        """
+        self.package_name = package_name
+        self.retained_versions = retained_versions
+        self.objects: List[Dict[str, Any]] = []
+        self.document_versions: List[Dict[str, Any]] = []
+
+    def deleted_objects(self, bucket_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the objects that would be deleted.
+
+        Args:
+            bucket_name (str, optional): Only return the objects of this bucket.
+
+        Returns:
+            List[Dict[str, Any]]: The objects, each with its bucket, key and size.
+        """
+        return [obj for obj in self.objects if obj['action'] == 'delete' and
+                bucket_name in (None, obj['bucket'])]
+
+    def deleted_document_versions(self) -> List[Dict[str, Any]]:
+        """Returns the document versions that would be deleted."""
+        return [doc for doc in self.document_versions if doc['action'] == 'delete']
+
+    def print_report(self) -> None:
+        """Prints what would be kept and deleted, and the number of bytes freed."""
+        print(f'Retention plan for {self.package_name}, keeping versions '
+              f'{", ".join(self.retained_versions) or "(none)"}')
+        print('Document versions:')
+        if not self.document_versions:
+            print('  (none)')
+        for doc in self.document_versions:
+            print(f'  {doc["action"]:<7} {doc["region"]:<15} version {doc["document_version"]:<5} '
+                  f'{doc["package_version"] or "-":<14} {doc["reason"]}')
+        print('Objects:')
+        if not self.objects:
+            print('  (none)')
+        for obj in self.objects:
+            print(f'  {obj["action"]:<7} {obj["size"]:>14} B  s3://{obj["bucket"]}/{obj["key"]}  '
+                  f'{obj["reason"]}')
+        deleted = self.deleted_objects()
+        print(f'Total to delete: {len(deleted)} objects, {sum(obj["size"] for obj in deleted)} '
+              f'bytes, {len(self.deleted_document_versions())} document versions')
+
+
+class PackageRetention:
+    """
+    Class to remove the package versions that are no longer needed.
+
+    The newest keep_versions package versions found in the buckets are kept, together with the
+    version being published and every file referenced by a live document version. The default
+    and latest versions of the Distributor document are always live. Other document versions
+    are live only if their manifest is for one of the kept package versions, and the rest are
+    deleted as stale. Everything else under the prefix that follows the zip file naming is
+    deleted from the buckets in batches of up to 1000 keys.
+    """
+
+    def __init__(self, ssm_clients: Dict[str, Any], package_name: str, keep_versions: int,
+                 prefix: str = 'uptycs', workers: int = DEFAULT_WORKERS):
+        # pylint: disable=R0913,R0917
+        """
+        Initializes an instance of the PackageRetention class.
+
+        Args:
+            ssm_clients (Dict[str, Any]): The SSM client of each region the Distributor
+                document is published in, keyed by region.
+            package_name (str): The name of the Distributor document.
+            keep_versions (int): The number of package versions to keep.
+            prefix (str): The S3 prefix holding the package files.
+            workers (int): The number of document versions read at the same time.
+
+        Raises:
+            ValueError: If keep_versions is less than 1.
+        """
+        if keep_versions < 1:
+            raise ValueError('At least one package version must be kept')
+        self.ssm_clients = ssm_clients
+        self.package_name = package_name
+        self.keep_versions = keep_versions
+        self.prefix = prefix
+        self.workers = workers
+
+    def plan(self, buckets: Dict[str, Any], current_version: Optional[str] = None
+             ) -> RetentionPlan:
+        """
+        Works out what to keep and delete without changing anything.
+
+        Args:
+            buckets (Dict[str, Any]): The S3 client of each bucket, keyed by bucket name.
+            current_version (str, optional): The package version being published, which is
+                always kept and counts as the newest version.
+
+        Returns:
+            RetentionPlan: The objects and document versions to keep and delete.
+        """
+        objects = {bucket_name: self._list_package_objects(bucket_name, s3_client)
+                   for bucket_name, s3_client in buckets.items()}
+        versions = {obj['version'] for bucket_objects in objects.values()
+                    for obj in bucket_objects}
+        newest = sorted(versions | ({current_version} - {None}), key=version_key,
+                        reverse=True)[:self.keep_versions]
+        if current_version and current_version not in newest:
+            newest.append(current_version)
+        plan = RetentionPlan(self.package_name, newest)
+
+        referenced: Set[str] = set()
+        for doc in self._document_versions():
+            if doc['is_default'] or doc['is_latest']:
+                doc.update(action='keep', reason='default version' if doc['is_default']
+                           else 'latest version')
+            elif doc['package_version'] in newest:
+                doc.update(action='keep', reason='kept package version')
+            else:
+                doc.update(action='delete', reason='stale')
+            if doc['action'] == 'keep':
+                referenced |= doc['files']
+            plan.document_versions.append(doc)
+
+        for bucket_name, bucket_objects in objects.items():
+            for obj in bucket_objects:
+                if obj['version'] in newest:
+                    obj.update(action='keep', reason='kept package version')
+                elif obj['name'] in referenced:
+                    obj.update(action='keep', reason='referenced by a live document version')
+                else:
+                    obj.update(action='delete', reason='old package version')
+                plan.objects.append({'bucket': bucket_name, **obj})
+        return plan
+
+    def apply(self, plan: RetentionPlan, buckets: Dict[str, Any]) -> None:
+        """
+        Deletes the stale document versions, then the old objects.
+
+        The objects are only deleted once every stale document version has been deleted, so
+        that no remaining document version refers to a deleted file.
+
+        Args:
+            plan (RetentionPlan): The plan returned by plan().
+            buckets (Dict[str, Any]): The S3 client of each bucket, keyed by bucket name.
+
+        Raises:
+            RetentionError: If a document version or object could not be deleted.
+        """
+        failures = []
+        for doc in plan.deleted_document_versions():
+            try:
+                self.ssm_clients[doc['region']].delete_document(
+                    Name=self.package_name, DocumentVersion=doc['document_version'])
+                print(f'Deleted document version {doc["document_version"]} of '
+                      f'{self.package_name} in {doc["region"]}')
+            except (BotoCoreError, ClientError) as err:
+                failures.append(f'document version {doc["document_version"]} in '
+                                f'{doc["region"]}: {err}')
+        if failures:
+            raise RetentionError('Unable to delete ' + '; '.join(failures))
+
+        for bucket_name, s3_client in buckets.items():
+            keys = [obj['key'] for obj in plan.deleted_objects(bucket_name)]
+            for start in range(0, len(keys), DELETE_BATCH_SIZE):
+                batch = keys[start:start + DELETE_BATCH_SIZE]
+                try:
+                    response = s3_client.delete_objects(
+                        Bucket=bucket_name,
+                        Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+                    failures += [f's3://{bucket_name}/{error["Key"]}: {error.get("Message")}'
+                                 for error in response.get('Errors', [])]
+                except (BotoCoreError, ClientError) as err:
+                    failures.append(f'{len(batch)} objects in {bucket_name}: {err}')
+            print(f'Deleted {len(keys)} old package files from {bucket_name}')
+        if failures:
+            raise RetentionError('Unable to delete ' + '; '.join(failures))
+
+    def _list_package_objects(self, bucket_name: str, s3_client) -> List[Dict[str, Any]]:
+        """
+        Lists the package zip files in a bucket.
+
+        Args:
+            bucket_name (str): The name of the S3 bucket.
+            s3_client (S3.Client): The S3 client for the bucket.
+
+        Returns:
+            List[Dict[str, Any]]: The key, file name, size and package version of each zip
+            file. A bucket that does not exist has none.
+        """
+        objects = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        try:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=f'{self.prefix}/'):
+                for item in page.get('Contents', []):
+                    name = item['Key'][len(self.prefix) + 1:]
+                    match = ZIP_NAME_PATTERN.match(name)
+                    if match:
+                        objects.append({'key': item['Key'], 'name': name, 'size': item['Size'],
+                                        'version': match.group('version')})
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') != 'NoSuchBucket':
+                raise
+        return objects
+
+    def _document_versions(self) -> List[Dict[str, Any]]:
+        """
+        Reads every version of the Distributor document in each region.
+
+        Returns:
+            List[Dict[str, Any]]: The region, document version, default and latest flags, and
+            the package version and zip files in the manifest of each document version.
+        """
+        versions = []
+        for region, ssm_client in self.ssm_clients.items():
+            try:
+                latest = ssm_client.describe_document(
+                    Name=self.package_name)['Document']['LatestVersion']
+                paginator = ssm_client.get_paginator('list_document_versions')
+                for page in paginator.paginate(Name=self.package_name):
+                    for item in page['DocumentVersions']:
+                        versions.append({
+                            'region': region,
+                            'document_version': item['DocumentVersion'],
+                            'is_default': item.get('IsDefaultVersion', False),
+                            'is_latest': item['DocumentVersion'] == latest})
+            except ssm_client.exceptions.InvalidDocument:
+                continue
+
+        def read_manifest(doc: Dict[str, Any]) -> Dict[str, Any]:
+            content = self.ssm_clients[doc['region']].get_document(
+                Name=self.package_name, DocumentVersion=doc['document_version'])['Content']
+            return json.loads(content)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for doc, manifest in zip(versions, executor.map(read_manifest, versions)):
+                doc['package_version'] = manifest.get('version')
+                doc['files'] = set(manifest.get('files', {}))
+        return versions
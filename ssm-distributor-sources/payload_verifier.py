@@ -0,0 +1,207 @@
+"""
+Verifies downloaded agent installers before they are packaged
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+DIGEST_ALGORITHMS = {'sha-256': 'sha256', 'md5': 'md5'}
+PACKAGE_SIGNATURES = {
+    '.rpm': [(0, b'\xed\xab\xee\xdb')],
+    '.deb': [(0, b'!<arch>\n'), (8, b'debian-binary')],
+    '.msi': [(0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1')]
+}
+DEFAULT_WORKERS = 4
+
+
+class PayloadVerificationError(Exception):
+    """Exception raised when one or more payloads fail verification."""
+
+
+class PayloadVerifier:
+    """
+    Class to check installers against their expected size, digests and package structure.
+
+    The expected values come from the download response headers and, optionally, a trusted
+    local catalog. The catalog is a JSON object keyed by file name, each value either the
+    SHA-256 hex digest or an object with "sha256" and/or "size" keys.
+    """
+
+    def __init__(self, catalog_file: Optional[str] = None, quarantine_dir: Optional[str] = None,
+                 workers: int = DEFAULT_WORKERS):
+        """
+        Initializes an instance of the PayloadVerifier class.
+
+        Args:
+            catalog_file (str, optional): The trusted checksum catalog.
+            quarantine_dir (str, optional): Where payloads that fail verification are moved to.
+                Failed payloads are left in place if not set.
+            workers (int): The number of payloads verified at the same time.
+        """
+        self.catalog: Dict[str, Dict] = self._load_catalog(catalog_file) if catalog_file else {}
+        self.quarantine_dir = quarantine_dir
+        self.workers = max(1, workers)
+        self.digests: Dict[str, str] = {}
+
+    @staticmethod
+    def expected_from_headers(headers) -> Dict:
+        """
+        Extracts the expected size and digests of a payload from the download response headers.
+
+        Args:
+            headers (Mapping[str, str]): The response headers.
+
+        Returns:
+            Dict: The expected "size", "sha256" and "md5" values that the server provided.
+        """
+        expected: Dict = {}
+        if headers.get('content-length') and not headers.get('content-encoding'):
+            expected['size'] = int(headers['content-length'])
+
+        digest_values = [headers.get('digest', ''), headers.get('repr-digest', '')]
+        if not headers.get('content-encoding'):
+            digest_values.append(headers.get('content-digest', ''))
+        for value in filter(None, digest_values):
+            for item in value.split(','):
+                algorithm, _, encoded = item.strip().partition('=')
+                name = DIGEST_ALGORITHMS.get(algorithm.strip().lower())
+                if name and encoded:
+                    expected[name] = PayloadVerifier._decode_digest(encoded.strip(':'))
+        if headers.get('content-md5'):
+            expected['md5'] = PayloadVerifier._decode_digest(headers['content-md5'])
+        return {key: value for key, value in expected.items() if value is not None}
+
+    def verify_all(self, payloads: Dict[str, Dict]) -> Dict[str, List[str]]:
+        """
+        Verifies the payloads in parallel and quarantines any that fail.
+
+        Args:
+            payloads (Dict[str, Dict]): The expected values of each payload, keyed by path.
+
+        Returns:
+            Dict[str, List[str]]: The problems found with each payload that failed.
+        """
+        paths = sorted(payloads)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = dict(zip(paths, executor.map(
+                lambda path: self.verify(path, payloads[path]), paths)))
+        failures = {path: problems for path, problems in results.items() if problems}
+        for path in failures:
+            if os.path.isfile(path):
+                self._quarantine(path)
+        return failures
+
+    def verify(self, path: str, expected: Optional[Dict] = None) -> List[str]:
+        """
+        Verifies a single payload, recording its SHA-256 digest in self.digests.
+
+        Args:
+            path (str): The payload to verify.
+            expected (Dict, optional): The expected "size", "sha256" and "md5" values.
+
+        Returns:
+            List[str]: The problems found, empty if the payload is valid.
+        """
+        if not os.path.isfile(path):
+            return ['file is missing']
+        problems = []
+        sources = [('server', expected or {})]
+        catalog_entry = self.catalog.get(os.path.basename(path))
+        if catalog_entry:
+            sources.append(('catalog', catalog_entry))
+        elif self.catalog:
+            problems.append('not listed in the checksum catalog')
+
+        header, actual = self._read_payload(path)
+        self.digests[path] = actual['sha256']
+        for source, values in sources:
+            for key in ('size', 'sha256', 'md5'):
+                if key in values and str(values[key]).lower() != str(actual[key]):
+                    problems.append(f'{key} {actual[key]} does not match {source} '
+                                    f'value {values[key]}')
+
+        signatures = PACKAGE_SIGNATURES.get(os.path.splitext(path)[1].lower(), [])
+        if any(header[offset:offset + len(magic)] != magic for offset, magic in signatures):
+            problems.append(f'not a valid {os.path.splitext(path)[1]} package')
+        return problems
+
+    @staticmethod
+    def _read_payload(path: str) -> Tuple[bytes, Dict]:
+        """
+        Reads a payload once, returning its leading bytes, size and digests.
+
+        Args:
+            path (str): The payload to read.
+
+        Returns:
+            Tuple[bytes, Dict]: The first 64 bytes and the "size", "sha256" and "md5" values.
+        """
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        with open(path, 'rb') as file_handle:
+            header = file_handle.read(64)
+            file_handle.seek(0)
+            for chunk in iter(lambda: file_handle.read(1024 * 1024), b''):
+                sha256.update(chunk)
+                md5.update(chunk)
+        return header, {'size': os.path.getsize(path), 'sha256': sha256.hexdigest(),
+                        'md5': md5.hexdigest()}
+
+    def _quarantine(self, path: str) -> None:
+        """
+        Moves a payload that failed verification out of the package directories.
+
+        Args:
+            path (str): The payload to move.
+        """
+        if not self.quarantine_dir:
+            return
+        os.makedirs(self.quarantine_dir, exist_ok=True)
+        parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        target = os.path.join(self.quarantine_dir,
+                              f'{parent}-{int(time.time())}-{os.path.basename(path)}')
+        shutil.move(path, target)
+        print(f'Quarantined {path} to {target}')
+
+    @staticmethod
+    def _decode_digest(value: str) -> Optional[str]:
+        """
+        Converts a base64 or hex encoded digest from a header to lower case hex.
+
+        Args:
+            value (str): The encoded digest.
+
+        Returns:
+            Optional[str]: The hex digest, None if the value could not be decoded.
+        """
+        value = value.strip()
+        if re.fullmatch(r'[0-9a-fA-F]{32}|[0-9a-fA-F]{64}', value):
+            return value.lower()
+        try:
+            return base64.b64decode(value, validate=True).hex()
+        except (binascii.Error, ValueError):
+            return None
+
+    @staticmethod
+    def _load_catalog(catalog_file: str) -> Dict[str, Dict]:
+        """
+        Loads the trusted checksum catalog.
+
+        Args:
+            catalog_file (str): The catalog file.
+
+        Returns:
+            Dict[str, Dict]: The expected values keyed by file name.
+        """
+        with open(catalog_file, 'r', encoding='utf-8') as file_handle:
+            catalog = json.load(file_handle)
+        return {name: value if isinstance(value, dict) else {'sha256': value}
+                for name, value in catalog.items()}
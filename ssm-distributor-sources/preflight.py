@@ -0,0 +1,189 @@
+"""
+Runs the preflight checks for a packaging run concurrently and caches the results
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+PREFLIGHT_CACHE_FILE = '.preflight-cache.json'
+PREFLIGHT_CACHE_TTL = 300
+MIN_FREE_DISK_BYTES = 2 * 1024 ** 3
+
+
+class PreflightFailure(Exception):
+    """Exception raised by a preflight check that did not pass."""
+
+
+class PreflightCheck:
+    # pylint: disable=R0903
+    """
+    Class to represent a single preflight check.
+    """
+
+    def __init__(self, name: str, func: Callable[[], str], cache_key: Optional[str] = None):
+        """
+        Initializes an instance of the PreflightCheck class.
+
+        Args:
+            name (str): The name of the check shown in the report.
+            func (Callable[[], str]): Runs the check and returns a message describing the
+                result. It raises PreflightFailure (or any other exception) if the check fails.
+            cache_key (str, optional): Identifies the inputs of the check. A passing result is
+                cached against this key, checks without a key are never cached.
+        """
+        self.name = name
+        self.func = func
+        self.cache_key = cache_key
+
+
+class PreflightResult:
+    # pylint: disable=R0903
+    """
+    Class to represent the outcome of a preflight check.
+    """
+
+    def __init__(self, name: str, passed: bool, message: str, cached: bool = False):
+        """
+        Initializes an instance of the PreflightResult class.
+
+        Args:
+            name (str): The name of the check.
+            passed (bool): Whether the check passed.
+            message (str): A description of the result.
+            cached (bool): Whether the result was read from the cache.
+        """
+        self.name = name
+        self.passed = passed
+        self.message = message
+        self.cached = cached
+
+    def __str__(self) -> str:
+        status = 'OK  ' if self.passed else 'FAIL'
+        cached = ' (cached)' if self.cached else ''
+        return f'[{status}] {self.name}: {self.message}{cached}'
+
+
+class PreflightRunner:
+    # pylint: disable=R0903
+    """
+    Class to run preflight checks concurrently, reusing recent passing results.
+    """
+
+    def __init__(self, cache_file: str = PREFLIGHT_CACHE_FILE, ttl: int = PREFLIGHT_CACHE_TTL):
+        """
+        Initializes an instance of the PreflightRunner class.
+
+        Args:
+            cache_file (str): The file used to cache passing results between runs.
+            ttl (int): The number of seconds a cached result remains valid. 0 disables the cache.
+        """
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+    def run(self, checks: List[PreflightCheck]) -> List[PreflightResult]:
+        """
+        Runs the checks concurrently.
+
+        Args:
+            checks (List[PreflightCheck]): The checks to run.
+
+        Returns:
+            List[PreflightResult]: The result of each check, in the order they were given.
+        """
+        cache = self._read_cache()
+        now = time.time()
+        results: Dict[str, PreflightResult] = {}
+        pending = []
+        for check in checks:
+            entry = cache.get(self._cache_id(check)) if check.cache_key else None
+            if entry and now - entry['time'] < self.ttl:
+                results[check.name] = PreflightResult(check.name, True, entry['message'], True)
+            else:
+                pending.append(check)
+
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                for check, result in zip(pending, executor.map(self._run_check, pending)):
+                    results[check.name] = result
+                    if result.passed and check.cache_key:
+                        cache[self._cache_id(check)] = {'time': now, 'message': result.message}
+            self._write_cache(cache, now)
+        return [results[check.name] for check in checks]
+
+    @staticmethod
+    def _run_check(check: PreflightCheck) -> PreflightResult:
+        """
+        Runs a single check and converts its outcome into a result.
+
+        Args:
+            check (PreflightCheck): The check to run.
+
+        Returns:
+            PreflightResult: The result of the check.
+        """
+        try:
+            return PreflightResult(check.name, True, check.func())
+        except PreflightFailure as error:
+            return PreflightResult(check.name, False, str(error))
+        except Exception as error:  # pylint: disable=W0718
+            return PreflightResult(check.name, False,
+                                   f'{error.__class__.__name__}: {error}'.rstrip(': '))
+
+    @staticmethod
+    def _cache_id(check: PreflightCheck) -> str:
+        """Returns the cache entry id for a check."""
+        key = f'{check.name}\n{check.cache_key}'.encode('utf-8')
+        return hashlib.sha256(key).hexdigest()
+
+    def _read_cache(self) -> Dict[str, Dict]:
+        """Reads the cached results, returning an empty cache if there is none."""
+        if self.ttl <= 0:
+            return {}
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as file_handle:
+                return json.load(file_handle)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, cache: Dict[str, Dict], now: float) -> None:
+        """Writes the cached results, dropping any that have expired."""
+        if self.ttl <= 0:
+            return
+        cache = {key: entry for key, entry in cache.items() if now - entry['time'] < self.ttl}
+        try:
+            with open(self.cache_file, 'w', encoding='utf-8') as file_handle:
+                json.dump(cache, file_handle)
+        except OSError:
+            pass
+
+
+def check_free_disk_space(paths: List[str], min_free_bytes: int = MIN_FREE_DISK_BYTES) -> str:
+    """
+    Checks that the filesystems holding the given paths have enough free space.
+
+    Args:
+        paths (List[str]): The paths that will be written to. Paths that do not exist yet are
+            checked using their nearest existing parent directory.
+        min_free_bytes (int): The minimum number of free bytes required.
+
+    Returns:
+        str: A description of the free space available.
+    """
+    free_space = {}
+    for path in paths:
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        free_space[path] = shutil.disk_usage(path).free
+    low = {path: free for path, free in free_space.items() if free < min_free_bytes}
+    if low:
+        raise PreflightFailure(', '.join(
+            f'{path} has {free / 1024 ** 3:.1f} GiB free' for path, free in low.items()) +
+            f' - at least {min_free_bytes / 1024 ** 3:.1f} GiB is required')
+    return ', '.join(f'{path} has {free / 1024 ** 3:.1f} GiB free'
+                     for path, free in free_space.items())
@@ -0,0 +1,267 @@
+"""
+Captures CPU profiles and memory allocation peaks for each stage of a packaging run
+"""
+
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_PROFILE_DIR = 'profiles'
+DEFAULT_TOP = 15
+DEFAULT_TRACE_FRAMES = 1
+
+
+class StageProfiler:
+    # pylint: disable=R0902
+    """
+    Class to profile the stages of a run and write the results.
+
+    Each stage is written to <output_dir>/<stage>.prof, which can be opened with pstats or any
+    tool that reads cProfile output. With memory tracing the allocation peak of each stage is
+    recorded, and a single tracemalloc snapshot of the allocations still held at the end of the
+    run is written to <output_dir>/memory.tracemalloc. A top-N summary of every stage and of the
+    snapshot is printed and written to <output_dir>/summary.txt.
+
+    cProfile only sees the thread that enabled it and only one profiler can be active at a time,
+    so when a stage runs in several threads at once only one call is CPU profiled at any moment.
+    The other calls are still counted and timed. A stage called from within another stage is
+    profiled on its own, and its time is left out of the outer stage's CPU profile. Memory is
+    traced for the whole process, so the peak of a stage covers all threads running it. Stages
+    only read the traced memory counters, so tracing does not hold up concurrent transfers.
+    """
+
+    def __init__(self, output_dir: str = DEFAULT_PROFILE_DIR, profile: bool = False,
+                 trace_memory: bool = False, top: int = DEFAULT_TOP,
+                 trace_frames: int = DEFAULT_TRACE_FRAMES):
+        # pylint: disable=R0913,R0917
+        """
+        Initializes an instance of the StageProfiler class.
+
+        Args:
+            output_dir (str): The directory the profile files and summary are written to.
+            profile (bool): Whether to capture CPU profiles.
+            trace_memory (bool): Whether to trace memory allocations.
+            top (int): The number of functions and allocation sites listed for each stage.
+            trace_frames (int): The number of frames stored for each traced allocation.
+        """
+        self.output_dir = output_dir
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.top = top
+        self.stats: Dict[str, pstats.Stats] = {}
+        self.timings: Dict[str, List[float]] = {}
+        self.memory: Dict[str, int] = {}
+        self.cpu_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.active: Dict[str, int] = {}
+        self.patches: List[Tuple[type, str, object]] = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any profiling was requested."""
+        return self.profile or self.trace_memory
+
+    def instrument(self, cls: type, method_names: List[str]) -> None:
+        """
+        Wraps methods of a class so that each call is profiled as the stage <class>.<method>.
+
+        Static and class methods keep their type. The original methods are restored by close().
+
+        Args:
+            cls (type): The class to instrument.
+            method_names (List[str]): The names of the methods to wrap.
+        """
+        if not self.enabled:
+            return
+        for name in method_names:
+            original = cls.__dict__[name]
+            stage = f'{cls.__name__}.{name}'
+            if isinstance(original, (staticmethod, classmethod)):
+                wrapped = type(original)(self.wrap(original.__func__, stage))
+            else:
+                wrapped = self.wrap(original, stage)
+            setattr(cls, name, wrapped)
+            self.patches.append((cls, name, original))
+
+    def wrap(self, func, stage: str):
+        """
+        Returns a function that runs func inside the given stage.
+
+        Args:
+            func (Callable): The function to wrap.
+            stage (str): The name of the stage.
+
+        Returns:
+            Callable: The wrapped function.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Profiles the code run inside the context as part of a stage.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        if not self.enabled:
+            yield
+            return
+        self._enter_memory(name)
+        stack = self._profiler_stack()
+        profiler = None
+        if self.profile and (stack or self.cpu_lock.acquire(False)):
+            profiler = cProfile.Profile()
+            if stack:
+                stack[-1].disable()
+            stack.append(profiler)
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler:
+                profiler.disable()
+                stack.pop()
+                if stack:
+                    stack[-1].enable()
+                else:
+                    self.cpu_lock.release()
+            with self.lock:
+                self.timings.setdefault(name, []).append(elapsed)
+                if profiler and name in self.stats:
+                    self.stats[name].add(profiler)
+                elif profiler:
+                    self.stats[name] = pstats.Stats(profiler)
+            self._exit_memory(name)
+
+    def _profiler_stack(self) -> List[cProfile.Profile]:
+        """Returns the CPU profilers of the stages the current thread is running."""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def close(self) -> None:
+        """
+        Restores the instrumented methods, writes the profile files and prints the summary.
+        """
+        for cls, name, original in reversed(self.patches):
+            setattr(cls, name, original)
+        self.patches = []
+        if not self.enabled:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        summary = io.StringIO()
+        for name, timings in self.timings.items():
+            summary.write(f'== {name}: {len(timings)} call(s), {sum(timings):.2f}s total, '
+                          f'{max(timings):.2f}s longest\n')
+            if name in self.stats:
+                prof_file = os.path.join(self.output_dir, f'{name}.prof')
+                self.stats[name].dump_stats(prof_file)
+                summary.write(f'CPU profile: {prof_file}\n')
+                self.stats[name].stream = summary
+                self.stats[name].sort_stats('cumulative').print_stats(self.top)
+            if name in self.memory:
+                summary.write(f'Memory peak: {self.memory[name] / 1024 ** 2:.1f} MiB\n')
+            summary.write('\n')
+        if self.trace_memory:
+            summary.write(self._memory_summary())
+        summary_file = os.path.join(self.output_dir, 'summary.txt')
+        with open(summary_file, 'w', encoding='utf-8') as file_handle:
+            file_handle.write(summary.getvalue())
+        for name, timings in self.timings.items():
+            peak = self.memory.get(name)
+            memory = f', peak {peak / 1024 ** 2:.1f} MiB' if peak is not None else ''
+            print(f'{name}: {len(timings)} call(s), {sum(timings):.2f}s{memory}')
+        print(f'Profile summary written to {summary_file}')
+
+    def _enter_memory(self, name: str) -> None:
+        """
+        Starts measuring the memory peak of a stage.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        if not self.trace_memory:
+            return
+        with self.lock:
+            self._record_peak()
+            self.active[name] = self.active.get(name, 0) + 1
+            self.memory.setdefault(name, 0)
+            tracemalloc.reset_peak()
+
+    def _exit_memory(self, name: str) -> None:
+        """
+        Records the memory peak of a stage when one of its calls ends.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        if not self.trace_memory:
+            return
+        with self.lock:
+            self._record_peak()
+            self.active[name] -= 1
+
+    def _record_peak(self) -> None:
+        """
+        Adds the peak since the last reset to every running stage, before it is reset again.
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        for name, count in self.active.items():
+            if count:
+                self.memory[name] = max(self.memory[name], peak)
+
+    def _memory_summary(self) -> str:
+        """
+        Writes a snapshot of the allocations still held at the end of the run and returns its
+        summary.
+
+        Returns:
+            str: The allocation sites holding the most memory.
+        """
+        snapshot = tracemalloc.take_snapshot()
+        snapshot_file = os.path.join(self.output_dir, 'memory.tracemalloc')
+        snapshot.dump(snapshot_file)
+        # Filtering the grouped statistics is much faster than filtering every trace
+        profiler_files = {module.__file__ for module in (cProfile, pstats, threading, tracemalloc,
+                                                         sys.modules[__name__])}
+        stats = [stat for stat in snapshot.statistics('lineno')
+                 if stat.traceback[0].filename not in profiler_files]
+        lines = [f'== Memory still allocated at the end of the run, snapshot: {snapshot_file}']
+        for stat in stats[:self.top]:
+            lines.append(f'  {stat.size / 1024:10.1f} KiB  {stat.traceback[0]}')
+        return '\n'.join(lines) + '\n'
+
+
+def add_profiler_arguments(parser, default_dir: Optional[str] = DEFAULT_PROFILE_DIR) -> None:
+    """
+    Adds the --profile, --trace_memory and --profile_dir options to an argument parser.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser to add the options to.
+        default_dir (str, optional): The default output directory.
+    """
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='OPTIONAL: Capture a CPU profile of each stage of the run')
+    parser.add_argument('--trace_memory', '--trace-memory', dest='trace_memory',
+                        action='store_true', default=False,
+                        help='OPTIONAL: Trace the memory allocation peak of each stage of the run')
+    parser.add_argument('--profile_dir', default=default_dir,
+                        help='OPTIONAL: Directory the profile files and summary are written to')
@@ -0,0 +1,8 @@
+"""
+Makes the packaging modules in ssm-distributor-sources importable by the tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,152 @@
+"""
+Tests that packaging runs share installers through the remote artifact cache
+"""
+
+import json
+import os
+import shutil
+
+import pytest
+import requests
+
+moto = pytest.importorskip('moto')
+
+# pylint: disable=C0413
+import create_package
+from artifact_cache import ArtifactCache
+
+SOURCES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERSION = '5.9.0.1'
+MAGIC = {'rpm': b'\xed\xab\xee\xdb', 'deb': b'!<arch>\ndebian-binary',
+         'msi': b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'}
+
+
+class FakeResponse:
+    """A response of the fake Uptycs API."""
+
+    def __init__(self, body=b'', headers=None, json_body=None):
+        self.status_code = 200
+        self.body = body
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.json_body = json_body
+        self.text = ''
+
+    def json(self):
+        """Returns the JSON body."""
+        return self.json_body
+
+    def iter_content(self, chunk_size):
+        """Yields the body in chunks."""
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        """Closes the response."""
+
+
+class FakeUptycsApi:
+    # pylint: disable=R0903
+    """Serves the Uptycs API calls of a packaging run and counts the installer downloads."""
+
+    def __init__(self):
+        self.downloads = 0
+
+    def request(self, _method, url, **_kwargs):
+        """Returns the response to an API request."""
+        if url.endswith('/objectGroups'):
+            return FakeResponse(json_body={'items': [{'name': 'assets', 'id': 'group-1'}]})
+        if url.endswith('/osqueryPackages'):
+            return FakeResponse(json_body={'items': [{'version': f'{VERSION}-1'}]})
+        self.downloads += 1
+        os_name = url.split('/packageDownloads/osquery/')[1].split('/')[0]
+        extension = {'windows': 'msi', 'debian': 'deb'}.get(os_name, 'rpm')
+        body = MAGIC[extension] + url.encode() * 50
+        file_name = f'osquery-{os_name}-{len(url)}.{extension}'
+        return FakeResponse(body, {'content-type': 'application/octet-stream',
+                                   'content-disposition': f'attachment; filename="{file_name}"',
+                                   'content-length': str(len(body))})
+
+
+@pytest.fixture(name='packaging')
+def fixture_packaging(tmp_path, monkeypatch):
+    """Returns the clients, fake API and cache of packaging runs against mocked AWS."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    api_config = tmp_path / 'key.json'
+    api_config.write_text(json.dumps({'key': 'key', 'secret': 'secret', 'domain': 'example',
+                                      'customerId': 'customer'}), encoding='utf-8')
+    with moto.mock_aws():
+        clients = create_package.PackagingClients(str(api_config))
+        api = FakeUptycsApi()
+        clients.api.session.request = api.request
+        s3_client = clients.s3('us-east-1')
+        s3_client.create_bucket(Bucket='ci-cache')
+        cache = ArtifactCache('s3://ci-cache/installers', s3_client)
+        yield clients, api, cache, s3_client
+        clients.close()
+
+
+def build(packaging, run_dir):
+    """Builds the package from a fresh copy of the package folders, as a new CI runner would."""
+    clients, _, cache, _ = packaging
+    source_dir = os.path.join(run_dir, 'src')
+    shutil.copytree(SOURCES_DIR, source_dir,
+                    ignore=lambda path, names: [] if path != SOURCES_DIR else [
+                        name for name in names
+                        if not (name.startswith('UPT_PRO_') or name == create_package.MAP_FILE)])
+    create_package.build_package(clients, 'package-bucket', 'us-east-1', VERSION, cache=cache,
+                                 source_dir=source_dir,
+                                 staging_dir=os.path.join(run_dir, 'stage'))
+    return source_dir
+
+
+def cached_objects(s3_client):
+    """Returns the body of each installer in the cache, keyed by object key."""
+    objects = s3_client.list_objects_v2(Bucket='ci-cache').get('Contents', [])
+    return {obj['Key']: s3_client.get_object(Bucket='ci-cache', Key=obj['Key'])['Body'].read()
+            for obj in objects}
+
+
+def test_cold_run_populates_cache(packaging):
+    """Every installer downloaded from the API is added to an empty cache."""
+    _, api, _, s3_client = packaging
+    build(packaging, 'run1')
+    cached = cached_objects(s3_client)
+    assert api.downloads > 0
+    assert len(cached) == api.downloads
+    for key in cached:
+        assert s3_client.head_object(Bucket='ci-cache', Key=key)['Metadata']['sha256']
+
+
+def test_warm_run_downloads_nothing(packaging):
+    """A run with a populated cache makes no installer downloads from the API."""
+    _, api, _, s3_client = packaging
+    build(packaging, 'run1')
+    cached = cached_objects(s3_client)
+    api.downloads = 0
+    source_dir = build(packaging, 'run2')
+    assert api.downloads == 0
+    assert cached_objects(s3_client) == cached
+    installers = set()
+    for path, _, names in os.walk(source_dir):
+        for name in names:
+            if name.rsplit('.', 1)[-1] in MAGIC:
+                with open(os.path.join(path, name), 'rb') as file_handle:
+                    installers.add(file_handle.read())
+    assert set(cached.values()) <= installers
+
+
+def test_corrupt_entry_is_replaced(packaging):
+    """A corrupt installer is removed from the cache and downloaded from the API again."""
+    _, api, _, s3_client = packaging
+    build(packaging, 'run1')
+    cached = cached_objects(s3_client)
+    key = sorted(cached)[0]
+    metadata = s3_client.head_object(Bucket='ci-cache', Key=key)['Metadata']
+    s3_client.put_object(Bucket='ci-cache', Key=key, Body=b'garbage' + cached[key][7:],
+                         Metadata=metadata)
+    api.downloads = 0
+    build(packaging, 'run2')
+    assert api.downloads == 1
+    assert cached_objects(s3_client) == cached
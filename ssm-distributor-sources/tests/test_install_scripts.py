@@ -0,0 +1,121 @@
+"""
+Tests that the Linux install scripts skip reinstalling a package that is already installed
+"""
+
+import os
+import subprocess
+
+import pytest
+
+from create_package import DistributorFilePackager
+
+SOURCES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_VERSION = '5.7.0.25-1'
+SHA256 = 'a' * 64
+
+# Fake package tools that record the installed version in $FAKE_DB
+FAKE_TOOLS = {
+    'rpm': r'''#!/bin/bash
+case "$1" in
+  -qp)
+    case "$3" in
+      %{NAME}) echo -n uptycs-protect ;;
+      *) echo -n "$FAKE_VERSION" ;;
+    esac ;;
+  -q) cat "$FAKE_DB/installed" 2>/dev/null || exit 1 ;;
+  -Uvh)
+    echo -n "$FAKE_VERSION" > "$FAKE_DB/installed"
+    echo "$3" >> "$FAKE_DB/installs" ;;
+esac
+''',
+    'dpkg-deb': r'''#!/bin/bash
+case "$3" in
+  Package) echo uptycs-protect ;;
+  Version) echo "$FAKE_VERSION" ;;
+esac
+''',
+    'dpkg-query': r'''#!/bin/bash
+[ -f "$FAKE_DB/installed" ] || exit 1
+echo -n "install ok installed $(cat "$FAKE_DB/installed")"
+''',
+    'dpkg': r'''#!/bin/bash
+echo -n "$FAKE_VERSION" > "$FAKE_DB/installed"
+echo "$2" >> "$FAKE_DB/installs"
+''',
+}
+
+
+@pytest.fixture(name='fake_host')
+def fixture_fake_host(tmp_path):
+    """Returns the environment of a host with the fake package tools first on its PATH."""
+    bin_dir = tmp_path / 'bin'
+    db_dir = tmp_path / 'db'
+    bin_dir.mkdir()
+    db_dir.mkdir()
+    for name, script in FAKE_TOOLS.items():
+        tool = bin_dir / name
+        tool.write_text(script, encoding='utf-8')
+        tool.chmod(0o755)
+    env = dict(os.environ, PATH=f'{bin_dir}{os.pathsep}{os.environ["PATH"]}',
+               FAKE_DB=str(db_dir), FAKE_VERSION=PACKAGE_VERSION)
+    return tmp_path, env
+
+
+def run_install(fake_host, dir_name, os_name, file_name, sha256):
+    """
+    Renders the install script of a package directory and runs it on the fake host.
+
+    Returns:
+        Tuple[subprocess.CompletedProcess, List[str]]: The result of the run and the
+        packages installed on the host so far.
+    """
+    tmp_path, env = fake_host
+    _, _, content = DistributorFilePackager._render_install_script(  # pylint: disable=W0212
+        os.path.join(SOURCES_DIR, dir_name), file_name, os_name, sha256)
+    content = content.replace('marker_dir=/var/lib/uptycs-distributor',
+                              f'marker_dir={tmp_path / "markers"}')
+    script = tmp_path / 'install.sh'
+    script.write_text(content, encoding='utf-8')
+    (tmp_path / file_name).touch()
+    result = subprocess.run(['bash', str(script)], cwd=tmp_path, env=env, capture_output=True,
+                            text=True, check=False)
+    installs = tmp_path / 'db' / 'installs'
+    return result, installs.read_text(encoding='utf-8').split() if installs.exists() else []
+
+
+PACKAGES = [
+    ('UPT_PRO_REDHAT_x86_64', 'centos', 'uptycs-protect-5.7.0.25-Uptycs.rpm'),
+    ('UPT_PRO_UBUNTU_x86_64', 'debian', 'uptycs-protect-5.7.0.25-Uptycs.deb'),
+]
+
+
+@pytest.mark.parametrize('dir_name,os_name,file_name', PACKAGES)
+def test_first_run_installs(fake_host, dir_name, os_name, file_name):
+    """The package is installed and its checksum recorded when nothing is installed."""
+    result, installs = run_install(fake_host, dir_name, os_name, file_name, SHA256)
+    assert result.returncode == 0, result.stderr
+    assert installs == [file_name]
+    marker = fake_host[0] / 'markers' / 'uptycs-protect.sha256'
+    assert marker.read_text(encoding='utf-8').strip() == SHA256
+
+
+@pytest.mark.parametrize('dir_name,os_name,file_name', PACKAGES)
+def test_second_run_skips_install(fake_host, dir_name, os_name, file_name):
+    """The same package version with the same checksum is not installed again."""
+    run_install(fake_host, dir_name, os_name, file_name, SHA256)
+    result, installs = run_install(fake_host, dir_name, os_name, file_name, SHA256)
+    assert result.returncode == 0, result.stderr
+    assert 'is already installed' in result.stdout
+    assert installs == [file_name]
+
+
+@pytest.mark.parametrize('dir_name,os_name,file_name', PACKAGES)
+def test_changed_checksum_reinstalls(fake_host, dir_name, os_name, file_name):
+    """A package with a different checksum is reinstalled, even for the same version."""
+    run_install(fake_host, dir_name, os_name, file_name, SHA256)
+    result, installs = run_install(fake_host, dir_name, os_name, file_name, 'b' * 64)
+    assert result.returncode == 0, result.stderr
+    assert 'is already installed' not in result.stdout
+    assert installs == [file_name, file_name]
+    marker = fake_host[0] / 'markers' / 'uptycs-protect.sha256'
+    assert marker.read_text(encoding='utf-8').strip() == 'b' * 64
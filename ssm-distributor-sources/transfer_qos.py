@@ -0,0 +1,177 @@
+"""
+Bandwidth and concurrency controls for package downloads and uploads
+"""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+STAGES = (DOWNLOAD, UPLOAD)
+MIB = 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+REPORT_INTERVAL = 5.0
+
+
+class TokenBucket:
+    # pylint: disable=R0903
+    """
+    Class to limit the rate at which bytes are transferred.
+
+    Callers take tokens for the bytes they are about to transfer. When there are not enough
+    tokens the caller sleeps until the bucket has refilled, so concurrent callers share the
+    rate between them and the combined throughput never exceeds it.
+    """
+
+    def __init__(self, rate: float, burst_seconds: float = 0.25):
+        """
+        Initializes an instance of the TokenBucket class.
+
+        Args:
+            rate (float): The maximum number of bytes per second.
+            burst_seconds (float): How many seconds worth of bytes may be sent at once after
+                the bucket has been idle.
+        """
+        self.rate = rate
+        self.capacity = rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        """
+        Takes tokens for the given number of bytes, sleeping until they are available.
+
+        Args:
+            amount (int): The number of bytes about to be transferred.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ThroughputMeter:
+    """
+    Class to measure and periodically report the throughput of a transfer stage.
+    """
+
+    def __init__(self, stage: str, interval: float = REPORT_INTERVAL):
+        """
+        Initializes an instance of the ThroughputMeter class.
+
+        Args:
+            stage (str): The name of the stage shown in the report.
+            interval (float): The minimum number of seconds between reports.
+        """
+        self.stage = stage
+        self.interval = interval
+        self.total = 0
+        self.started: Optional[float] = None
+        self.last_report = (0.0, 0)
+        self.lock = threading.Lock()
+
+    def record(self, amount: int) -> None:
+        """
+        Records transferred bytes, printing the current throughput if a report is due.
+
+        Args:
+            amount (int): The number of bytes transferred.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.started is None:
+                self.started = now
+                self.last_report = (now, 0)
+            self.total += amount
+            last_time, last_total = self.last_report
+            if now - last_time < self.interval:
+                return
+            self.last_report = (now, self.total)
+            current = (self.total - last_total) / (now - last_time)
+            average = self.total / (now - self.started)
+        print(f'{self.stage}: {current / MIB:.2f} MiB/s now, {average / MIB:.2f} MiB/s average, '
+              f'{self.total / MIB:.1f} MiB transferred')
+
+    def summary(self) -> str:
+        """Returns the total bytes transferred and the average throughput."""
+        with self.lock:
+            if self.started is None:
+                return f'{self.stage}: nothing transferred'
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            return (f'{self.stage}: {self.total / MIB:.1f} MiB in {elapsed:.1f}s, '
+                    f'{self.total / elapsed / MIB:.2f} MiB/s average')
+
+
+class TransferQos:
+    """
+    Class to apply the global and per stage bandwidth caps and concurrency limits.
+    """
+
+    def __init__(self, max_bandwidth: Optional[float] = None,
+                 stage_bandwidth: Optional[Dict[str, Optional[float]]] = None,
+                 download_concurrency: int = DEFAULT_CONCURRENCY,
+                 upload_concurrency: int = DEFAULT_CONCURRENCY):
+        """
+        Initializes an instance of the TransferQos class.
+
+        Args:
+            max_bandwidth (float, optional): The combined cap for all stages in bytes per second.
+            stage_bandwidth (Dict[str, Optional[float]], optional): The cap for each stage in
+                bytes per second, keyed by "download" or "upload".
+            download_concurrency (int): The number of packages downloaded at the same time.
+            upload_concurrency (int): The number of files uploaded at the same time.
+        """
+        stage_bandwidth = stage_bandwidth or {}
+        self.global_bucket = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self.stage_buckets = {stage: TokenBucket(stage_bandwidth[stage])
+                              for stage in STAGES if stage_bandwidth.get(stage)}
+        self.meters = {stage: ThroughputMeter(stage) for stage in STAGES}
+        self.download_concurrency = max(1, download_concurrency)
+        self.upload_concurrency = max(1, upload_concurrency)
+
+    def consume(self, stage: str, amount: int) -> None:
+        """
+        Waits until the bytes may be transferred within the caps and records them.
+
+        Args:
+            stage (str): Either "download" or "upload".
+            amount (int): The number of bytes about to be transferred. boto3 reports a
+                negative amount when a transfer is retried, which is ignored.
+        """
+        if amount <= 0:
+            return
+        if stage in self.stage_buckets:
+            self.stage_buckets[stage].consume(amount)
+        if self.global_bucket:
+            self.global_bucket.consume(amount)
+        self.meters[stage].record(amount)
+
+    def callback(self, stage: str) -> Callable[[int], None]:
+        """
+        Returns a progress callback, as used by boto3 transfers, that applies the caps.
+
+        Args:
+            stage (str): Either "download" or "upload".
+
+        Returns:
+            Callable[[int], None]: A function taking the number of bytes transferred.
+        """
+        return lambda amount: self.consume(stage, amount)
+
+    def summary(self, stage: str) -> str:
+        """
+        Returns the throughput summary for a stage.
+
+        Args:
+            stage (str): Either "download" or "upload".
+
+        Returns:
+            str: The total bytes transferred and the average throughput.
+        """
+        return self.meters[stage].summary()
@@ -4,14 +4,19 @@ The package will be shared from an Uptycs account and appear in your "Shared Wit
 """
 
 import argparse
+import contextlib
 import datetime
 import json
 import logging
 import os
+import sys
 import time
 import jwt
 import requests
 
+PROFILER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                            'ssm-distributor-sources')
+
 # pylint: disable=R0903
 class LogHandler:
     """A class to encapsulate logging setup and methods for serialization."""
@@ -97,6 +102,24 @@ class UptApiAuth:
             'Content-type': "application/json"}
 
 
+def load_profiler(args):
+    """
+    Create the stage profiler shared with the packaging scripts in ssm-distributor-sources.
+
+    It is only imported when profiling is requested, so the script keeps working on its own
+    without that folder.
+    """
+    if not (args.profile or args.trace_memory):
+        return None
+    sys.path.insert(0, PROFILER_DIR)
+    try:
+        from stage_profiler import StageProfiler  # pylint: disable=C0415
+    except ImportError as error:
+        raise SystemExit('--profile and --trace_memory need the ssm-distributor-sources folder '
+                         'of the repository next to this folder') from error
+    return StageProfiler(args.profile_dir, args.profile, args.trace_memory)
+
+
 def main():
     """Main entry point"""
     logger = LogHandler('auth_logger')
@@ -108,9 +131,18 @@ def main():
                         help='The JSON file containing regions')
     parser.add_argument('-l', '--log', default='info', type=str, choices=['debug', 'info'],
                         help='Set the log level (default: info)')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Capture a CPU profile of each stage of the script')
+    parser.add_argument('--trace_memory', '--trace-memory', dest='trace_memory',
+                        action='store_true', default=False,
+                        help='Trace the memory allocation peak of each stage of the script')
+    parser.add_argument('--profile_dir', default='profiles',
+                        help='Directory the profile files are written to (default: profiles)')
     args = parser.parse_args()
     level = logging.DEBUG if args.log == 'debug' else logging.INFO
     logger.logger.setLevel(level)
+    profiler = load_profiler(args)
+    stage = profiler.stage if profiler else lambda name: contextlib.nullcontext()
 
     # Get account_id from arguments
     account_id = args.account_id
@@ -120,10 +152,16 @@ def main():
         data = json.load(read_file)
     regions = ",".join(data['regions'])
 
-    auth_token = UptApiAuth(args.api_key_file, logger=logger)
-    params = {"regions": regions}
-    url = f'{auth_token.base_url}/packagedownloads/osqueryssm/terraform/{account_id}'
-    response = requests.get(url, headers=auth_token.header, params=params,timeout=10)
+    try:
+        with stage('auth'):
+            auth_token = UptApiAuth(args.api_key_file, logger=logger)
+        params = {"regions": regions}
+        url = f'{auth_token.base_url}/packagedownloads/osqueryssm/terraform/{account_id}'
+        with stage('share'):
+            response = requests.get(url, headers=auth_token.header, params=params,timeout=10)
+    finally:
+        if profiler:
+            profiler.close()
 
     if response.status_code == 200:
         logger.log_message('critical', f"Success! Server responded with: {response.status_code}")